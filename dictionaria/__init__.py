@@ -3,12 +3,16 @@ from functools import partial
 from pyramid.config import Configurator
 
 from clld import interfaces
-from clld.web.app import menu_item
+from clld.db.models import common
+from clld.web.app import menu_item, CtxFactoryQuery
 from clld_glottologfamily_plugin.util import LanguageByFamilyMapMarker
 
 # we must make sure custom models are known at database initialization!
 from dictionaria import models
 from dictionaria import md
+from dictionaria import views
+from dictionaria.interfaces import IFragmentCache
+from dictionaria.lib import cache
 
 _ = lambda s: s
 _('Parameter')
@@ -36,6 +40,14 @@ class MyMapMarker(LanguageByFamilyMapMarker):
         return LanguageByFamilyMapMarker.get_icon(self, ctx, req)
 
 
+class DictionariaCtxFactoryQuery(CtxFactoryQuery):
+    def refined_query(self, query, model, req):
+        if model == common.Unit:
+            return models.Word.refine_factory_query(
+                req.db.query(models.Word).filter(models.Word.id == req.matchdict['id']))
+        return query
+
+
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
@@ -44,9 +56,21 @@ def main(global_config, **settings):
     config.include('clldmpg')
     config.include('clld_glottologfamily_plugin')
     config.registry.registerUtility(MyMapMarker(), interfaces.IMapMarker)
+    config.registry.registerUtility(
+        DictionariaCtxFactoryQuery(), interfaces.ICtxFactoryQuery)
+    fragment_cache = cache.from_settings(settings)
+    if fragment_cache:
+        config.registry.registerUtility(fragment_cache, IFragmentCache)
 
     config.add_page('submit')
     config.add_page('help')
+    config.add_route('search', '/search')
+    config.add_view(views.search, route_name='search')
+    config.add_route('contribution_words', '/contributions/{id}/words.{ext:jsonl|csv}')
+    config.add_view(views.words, route_name='contribution_words')
+    config.add_route('cache', '/_cache')
+    config.add_view(views.cache_stats, route_name='cache', renderer='json')
+    config.add_tween('dictionaria.tweens.conditional_get_tween_factory')
     config.register_menu(
         ('dataset', partial(menu_item, 'dataset', label='Home')),
         ('contributions', partial(menu_item, 'contributions')),
@@ -1,2 +1,34 @@
+from __future__ import unicode_literals
+
+from clld import interfaces
+from clld.web.adapters.base import Representation
+
+from dictionaria.interfaces import IFragmentCache
+
+# Resources with detail pages served from the cache of rendered pages:
+CACHED = [
+    (interfaces.IUnit, 'unit'),
+    (interfaces.ISentence, 'sentence'),
+    (interfaces.IParameter, 'parameter'),
+    (interfaces.IValueSet, 'valueset'),
+    (interfaces.IContribution, 'contribution'),
+]
+
+
+class CachedRepresentation(Representation):
+    """
+    HTML detail page, rendered once per data generation and URL.
+    """
+    def render(self, ctx, req):
+        cache = req.registry.queryUtility(IFragmentCache)
+        if cache is None:
+            return Representation.render(self, ctx, req)
+        return cache.get(
+            ' '.join([self.template, ctx.id, req.url]),
+            lambda: Representation.render(self, ctx, req))
+
+
 def includeme(config):
-    pass
+    config.register_adapters([
+        (if_, CachedRepresentation, 'text/html', 'html', name + '/detail_html.mako', {})
+        for if_, name in CACHED])
@@ -2,8 +2,8 @@ from __future__ import unicode_literals
 
 from collections import OrderedDict
 
-from sqlalchemy import and_, or_, func
-from sqlalchemy.orm import joinedload_all, joinedload, aliased
+from sqlalchemy import and_
+from sqlalchemy.orm import joinedload_all, joinedload, contains_eager
 
 from clld.web import datatables
 from clld.web.datatables.base import (
@@ -26,9 +26,10 @@ from clldmpg.cdstar import MediaCol, maintype, bitstream_url
 
 from dictionaria.models import (
     Word, Counterpart, Dictionary, ComparisonMeaning, Variety, Example,
-    DictionarySource,
+    DictionarySource, WordListing,
 )
-from dictionaria.util import concepticon_link, split
+from dictionaria.util import concepticon_link, split, MULT_VALUE_SEP
+from dictionaria import search
 
 
 class GlottocodeCol(Col):
@@ -96,23 +97,25 @@ class WordCol(LinkCol):
         return dict(title=item.name, label=item.label)
 
     def order(self):
+        if self.dt.contribution:
+            return WordListing.name, WordListing.number
         return Word.name, Word.number
 
     def search(self, qs):
-        return or_(
-            icontains(Word.name, qs),
-            func.unaccent(Word.name).contains(func.unaccent(qs)))
+        return search.search(Word.name, qs)
 
 
 class CustomCol(Col):
     def search(self, qs):
-        return icontains(self.dt.vars[self.name].value, qs)
+        return icontains(self.dt.vars[self.name], qs)
 
     def format(self, item):
-        return item.datadict().get(self.name, '')
+        if item.listing is None:  # prime_cache has not been run.
+            return MULT_VALUE_SEP.join(d.value for d in item.data if d.key == self.name)
+        return item.listing.data.get(self.name, '')
 
     def order(self):
-        return self.dt.vars[self.name].value
+        return self.dt.vars[self.name]
 
 
 class SemanticDomainCol(Col):
@@ -123,7 +126,7 @@ class SemanticDomainCol(Col):
         Col.__init__(self, dt, name, **kw)
 
     def search(self, qs):
-        return icontains(Word.semantic_domain, qs)
+        return icontains(WordListing.semantic_domain, qs)
 
     def format(self, item):
         return HTML.ul(
@@ -136,9 +139,13 @@ class ThumbnailCol(Col):
 
     def format(self, item):
         item = self.get_obj(item)
-        for f in item.iterfiles():
-            if maintype(f) == 'image':
-                return HTML.img(src=bitstream_url(f, type_='thumbnail'))
+        if item.listing is None:  # prime_cache has not been run.
+            for f in item.iterfiles():
+                if maintype(f) == 'image':
+                    return HTML.img(src=bitstream_url(f, type_='thumbnail'))
+            return ''
+        if item.listing.thumbnail:
+            return HTML.img(src=item.listing.thumbnail)
         return ''
 
 
@@ -166,19 +173,20 @@ class Words(datatables.Units):
             self.eid = 'second_tab'
         self.vars = OrderedDict()
         if self.contribution:
-            for name in self.contribution.jsondata.get(
-                    'second_tab' if self.second_tab else 'custom_fields', []):
-                if name in self.contribution.jsondata.get('metalanguages', {}).values():
-                    name = 'lang-{0}'.format(name)
-                self.vars[name] = aliased(common.Unit_data, name=name)
+            for name in self.contribution.custom_field_keys(
+                    'second_tab' if self.second_tab else 'custom_fields'):
+                self.vars[name] = WordListing.data[name].astext
 
     def base_query(self, query):
-        if self.second_tab:
-            query = query.filter(Word.dictionary_pk == self.contribution.pk) \
-                .options(joinedload(common.Unit.data))
-            for name, var in self.vars.items():
-                query = query.outerjoin(var, and_(var.key == name, var.object_pk == Word.pk))
-            return query.distinct()
+        if self.contribution:
+            # The words of a dictionary are listed from the denormalized WordListing -
+            # outer joined, to list the words before prime_cache has been run, too:
+            query = query.outerjoin(WordListing, WordListing.pk == Word.pk)\
+                .filter(Word.dictionary_pk == self.contribution.pk)\
+                .options(contains_eager(Word.listing))
+            if not self.second_tab and self.contribution.count_audio:
+                query = query.options(joinedload(common.Unit._files))
+            return query
 
         query = query.join(Dictionary)\
             .outerjoin(common.Unit_data, and_(
@@ -190,36 +198,33 @@ class Words(datatables.Units):
                 joinedload(common.Unit.data),
                 joinedload(common.Unit._files),
             )
-        if self.contribution:
-            for name, var in self.vars.items():
-                query = query.outerjoin(var, and_(var.key == name, var.object_pk == Word.pk))
-            query = query.filter(Word.dictionary_pk == self.contribution.pk)
-
         return query.distinct()
 
     def col_defs(self):
         poscol = Col(self, 'part_of_speech', model_col=Word.pos)
         if self.contribution:
-            pos = sorted((c for c, in DBSession.query(Word.pos)
-                         .filter(Word.dictionary_pk == self.contribution.pk)
-                         .distinct() if c))
+            pos = self.contribution.jsondata.get('pos')
+            if pos is None:  # prime_cache has not been run.
+                pos = sorted((c for c, in DBSession.query(Word.pos)
+                             .filter(Word.dictionary_pk == self.contribution.pk)
+                             .distinct() if c))
             res = [
                 FtsCol(self, 'fts', sTitle='full entry', model_col=Word.fts),
-                WordCol(self, 'word', sTitle='headword', model_col=common.Unit.name),
+                WordCol(self, 'word', sTitle='headword', model_col=WordListing.name),
                 Col(self,
                     'part_of_speech',
                     sTitle='part of speech',
-                    model_col=Word.pos,
+                    model_col=WordListing.pos,
                     choices=pos,
                     format=lambda i: HTML.span(i.pos or '', class_='vocabulary')),
                 MeaningDescriptionCol2(self,
                     'description',
                     sTitle='meaning description',
-                    model_col=common.Unit.description),
+                    model_col=WordListing.description),
                 Col(self,
                     'examples',
                     input_size='mini',
-                    model_col=Word.example_count),
+                    model_col=WordListing.example_count),
             ]
             if self.second_tab:
                 for name in self.vars:
@@ -457,7 +462,8 @@ class Examples(Sentences):
                 'dictionary',
                 model_col=Dictionary.name,
                 get_obj=lambda i: i.dictionary,
-                choices=get_distinct_values(Dictionary.name)))
+                choices=self.req.dataset.jsondata.get('dictionary_names')
+                or get_distinct_values(Dictionary.name)))
         return res
 
     def get_options(self):
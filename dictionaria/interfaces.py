@@ -1,2 +1,5 @@
 from zope.interface import Interface
 
+
+class IFragmentCache(Interface):
+    """marker interface for the cache of rendered pages, see `dictionaria.lib.cache`."""
@@ -0,0 +1,320 @@
+# coding: utf8
+"""
+Writing the rows of a submission to the database.
+
+The loaders describe each new row as a model class plus keyword arguments and let a
+writer decide how to persist it:
+
+- `SessionWriter` creates ORM objects in `DBSession`, i.e. the unit of work issues one
+  INSERT per object when the session is flushed.
+- `BulkWriter` collects plain rows and writes each table with batched `executemany`
+  statements.
+
+Both writers pre-allocate primary keys in blocks from the table sequences, so loaders
+can reference new rows by pk without flushing, and both produce the same database.
+"""
+from __future__ import unicode_literals, print_function, division
+from collections import OrderedDict, defaultdict, deque
+import time
+
+from sqlalchemy import bindparam, func, literal_column
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.dialects.postgresql import TSVECTOR
+
+from clld.db.meta import Base, DBSession
+
+__all__ = ['SessionWriter', 'BulkWriter', 'RecordingWriter', 'get_writer']
+
+
+WEIGHTS = 'ABCD'
+
+
+def weighted(value):
+    """
+    :param value: Text, or `dict` mapping full-text search weights A, B, C and D to text.
+    :return: `dict` mapping all weights to text - unweighted text getting weight D, the \
+    default weight of lexemes in a tsvector.
+    """
+    if value is None:
+        return {w: None for w in WEIGHTS}
+    if not isinstance(value, dict):
+        value = {'D': value}
+    return {w: value.get(w) or '' for w in WEIGHTS}
+
+
+def tsvector(texts):
+    """
+    :param texts: `dict` mapping weights to text or SQL expressions.
+    :return: SQL expression for the concatenation of weighted tsvectors.
+    """
+    res = None
+    for w in WEIGHTS:
+        vector = func.setweight(
+            func.to_tsvector('english', texts[w]), literal_column("'{0}'".format(w)))
+        res = vector if res is None else res.op('||')(vector)
+    return res
+
+
+class Row(dict):
+    """
+    The values of a new row, accessible as attributes - like the ORM objects returned by
+    `SessionWriter.add`.
+    """
+    def __getattr__(self, item):
+        try:
+            return self[item]
+        except KeyError:
+            raise AttributeError(item)
+
+
+_tables = {}
+
+
+def tables(model):
+    """
+    :return: The tables a model class is mapped to, base table first.
+    """
+    if model not in _tables:
+        _tables[model] = [
+            m.local_table for m in reversed(list(class_mapper(model).iterate_to_root()))]
+    return _tables[model]
+
+
+def root(table):
+    """
+    :return: The base table of a table in a joined table inheritance hierarchy.
+    """
+    for fk in table.c.pk.foreign_keys:
+        return root(fk.column.table)
+    return table
+
+
+def values(obj):
+    """
+    :return: `dict` of the column values set on a - typically transient - ORM object.
+    """
+    return {
+        c.key: getattr(obj, c.key) for table in tables(type(obj)) for c in table.c
+        if getattr(obj, c.key, None) is not None}
+
+
+class SessionWriter(object):
+    """
+    Persists new rows as ORM objects.
+    """
+    block_size = 1000
+    checkpoint_size = 20000
+
+    def __init__(self):
+        self._pks = {}
+        self.pending = 0
+        self.counts = OrderedDict()
+        self.seconds = OrderedDict()
+
+    def pk(self, model):
+        """
+        :return: A new primary key for `model`, taken from a pre-allocated block of \
+        values of the sequence of the model's base table.
+        """
+        return self._next_pk(tables(model)[0].name)
+
+    def _next_pk(self, table):
+        pks = self._pks.get(table)
+        if not pks:
+            pks = self._pks[table] = deque(r[0] for r in DBSession.execute(
+                "SELECT nextval(pg_get_serial_sequence(:table, 'pk')) "
+                "FROM generate_series(1, :n)",
+                dict(table=table, n=self.block_size)))
+        return pks.popleft()
+
+    def add(self, model, **kw):
+        """
+        Register a new row.
+
+        :return: An object providing attribute access to the values of the row, \
+        including its `pk`.
+        """
+        kw.setdefault('pk', self.pk(model))
+        self.pending += 1
+        for table in tables(model):
+            self.counts[table.name] = self.counts.get(table.name, 0) + 1
+        return self._add(model, kw)
+
+    def _add(self, model, kw):
+        for table in tables(model):
+            for col in table.c:
+                if isinstance(col.type, TSVECTOR) and kw.get(col.key) is not None:
+                    kw[col.key] = tsvector(weighted(kw[col.key]))
+        obj = model(**kw)
+        DBSession.add(obj)
+        return obj
+
+    def checkpoint(self):
+        """
+        Flush the pending rows if there are more than `checkpoint_size`.
+
+        Loaders may call this whenever all rows referenced by new rows have been added,
+        to write rows while still reading a submission.
+        """
+        if self.pending >= self.checkpoint_size:
+            self.flush()
+
+    def _time(self, key, start):
+        self.seconds[key] = self.seconds.get(key, 0) + time.time() - start
+
+    def flush(self):
+        start = time.time()
+        DBSession.flush()
+        self.pending = 0
+        self._time('total', start)
+
+    def report(self):
+        for table, count in self.counts.items():
+            print('{0}: {1} rows'.format(table, count))
+        if self.seconds:
+            print('flushed in {0:.1f}s'.format(sum(self.seconds.values())))
+
+
+class BulkWriter(SessionWriter):
+    """
+    Persists new rows with one `executemany` per table and batch.
+
+    Since rows do not pass through the ORM, values must be column values (i.e. `word_pk`
+    rather than `word`). Text - or a `dict` mapping weights to text - passed for a
+    `TSVECTOR` column is converted with `to_tsvector` by the database.
+    """
+    batch_size = 5000
+
+    def __init__(self):
+        SessionWriter.__init__(self)
+        self.rows = defaultdict(list)
+
+    def _add(self, model, kw):
+        self.rows[model].append(kw)
+        return Row(kw)
+
+    def extend(self, batches):
+        """
+        Add the rows recorded by a `RecordingWriter`, replacing placeholder primary keys
+        - and foreign keys pointing to them - with keys allocated from the sequences.
+        """
+        pks = {}
+
+        def pk(table, value):
+            if table is None or value is None or value > 0:
+                return value
+            if (table, value) not in pks:
+                pks[table, value] = self._next_pk(table)
+            return pks[table, value]
+
+        for model, keys, rows in batches:
+            refs = []
+            for key in keys:
+                ref = None
+                for table in tables(model):
+                    if key == 'pk':
+                        ref = root(table).name
+                    elif key in table.c:
+                        for fk in table.c[key].foreign_keys:
+                            ref = root(fk.column.table).name
+                refs.append(ref)
+            for row in rows:
+                self.add(model, **{k: pk(ref, v) for k, ref, v in zip(keys, refs, row)})
+
+    def _table_rows(self):
+        res = defaultdict(list)
+        for model, rows in self.rows.items():
+            mapper = class_mapper(model)
+            if mapper.polymorphic_on is not None:
+                for row in rows:
+                    row.setdefault(mapper.polymorphic_on.key, mapper.polymorphic_identity)
+            for row in rows:
+                row.setdefault('jsondata', {})
+            for table in tables(model):
+                cols = OrderedDict()
+                for row in rows:
+                    for key in row:
+                        if key in table.c:
+                            cols[key] = table.c[key]
+                defaults = {
+                    k: c.default.arg if c.default is not None and c.default.is_scalar
+                    else None for k, c in cols.items()}
+                res[table].append([
+                    {k: row.get(k, defaults[k]) for k in cols} for row in rows])
+        return res
+
+    def _statement(self, table, keys):
+        stmt = table.insert()
+        values = {}
+        for key in keys:
+            if isinstance(table.c[key].type, TSVECTOR):
+                values[key] = tsvector(
+                    {w: bindparam('{0}_{1}'.format(key, w)) for w in WEIGHTS})
+        return stmt.values(**values) if values else stmt
+
+    def _params(self, table, rows):
+        for row in rows:
+            for key in list(row.keys()):
+                if isinstance(table.c[key].type, TSVECTOR):
+                    for w, text in weighted(row.pop(key)).items():
+                        row['{0}_{1}'.format(key, w)] = text
+        return rows
+
+    def flush(self):
+        # Make sure objects we reference - created with the ORM - are in the database:
+        DBSession.flush()
+        table_rows = self._table_rows()
+        for table in Base.metadata.sorted_tables:
+            start = time.time()
+            for rows in table_rows.get(table, []):
+                keys = list(rows[0].keys())
+                stmt = self._statement(table, keys)
+                for i in range(0, len(rows), self.batch_size):
+                    DBSession.execute(
+                        stmt, self._params(table, rows[i:i + self.batch_size]))
+            if table in table_rows:
+                self._time(table.name, start)
+        self.rows = defaultdict(list)
+        self.pending = 0
+
+    def report(self):
+        for table, count in self.counts.items():
+            seconds = self.seconds.get(table)
+            if seconds:
+                print('{0}: {1} rows in {2:.1f}s ({3:.0f} rows/s)'.format(
+                    table, count, seconds, count / seconds))
+            else:
+                print('{0}: {1} rows'.format(table, count))
+
+
+class RecordingWriter(BulkWriter):
+    """
+    Collects rows without touching the database - e.g. in a worker process - using
+    negative placeholder primary keys.
+    """
+    def _next_pk(self, table):
+        self._pks[table] = self._pks.get(table, 0) - 1
+        return self._pks[table]
+
+    def checkpoint(self):
+        # All rows are passed on at once.
+        pass
+
+    def flush(self):
+        raise NotImplementedError('rows must be passed to a BulkWriter for writing')
+
+    def batches(self):
+        """
+        :return: The recorded rows as compact list of `(model, keys, rows)` triples, \
+        with rows as tuples of values, suitable for `BulkWriter.extend`.
+        """
+        res = OrderedDict()
+        for model, rows in self.rows.items():
+            for row in rows:
+                keys = tuple(sorted(row.keys()))
+                res.setdefault((model, keys), []).append(tuple(row[k] for k in keys))
+        return [(model, keys, rows) for (model, keys), rows in res.items()]
+
+
+def get_writer(bulk=False):
+    return BulkWriter() if bulk else SessionWriter()
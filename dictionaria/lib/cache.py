@@ -0,0 +1,261 @@
+# coding: utf8
+"""
+Cache for rendered pages, keyed by data generation.
+
+The database only changes when dictionaries are (re-)loaded. Each run of `prime_cache`
+bumps the data generation - a stamp stored in a file, thus shared by all processes
+serving the app - and cached fragments of older generations are never used again.
+
+Fragments are stored in one of two backends:
+
+- `LRU`: an in-process dict, bounded by number of items,
+- `FileBackend`: a directory of files - which may be shared by processes, bounded by
+  total size.
+"""
+from __future__ import unicode_literals, print_function, division
+from collections import OrderedDict
+from hashlib import sha1
+import threading
+import time
+import os
+
+from clldutils.path import Path
+
+import dictionaria
+
+__all__ = [
+    'GENERATION', 'generation', 'bump', 'LRU', 'FileBackend', 'FragmentCache',
+    'from_settings']
+
+GENERATION = Path(dictionaria.__file__).parent.joinpath('static', 'generation.txt')
+
+_generations = {}
+
+
+def generation(path=GENERATION):
+    """
+    :return: The current data generation, i.e. the stamp written by the last `bump`, or \
+    `'0'` if there is none.
+    """
+    try:
+        mtime = os.stat(path.as_posix()).st_mtime
+    except OSError:
+        return '0'
+    # The file is only read again when it has been changed - possibly by another process:
+    cached = _generations.get(path.as_posix())
+    if cached and cached[0] == mtime:
+        return cached[1]
+    with open(path.as_posix()) as fp:
+        stamp = fp.read().strip() or '0'
+    _generations[path.as_posix()] = (mtime, stamp)
+    return stamp
+
+
+def bump(path=GENERATION):
+    """
+    Start a new data generation.
+
+    :return: The new stamp.
+    """
+    stamp = '{0:x}'.format(int(time.time() * 1000000))
+    tmp = path.parent.joinpath(path.name + '.tmp')
+    with open(tmp.as_posix(), 'w') as fp:
+        fp.write(stamp)
+    os.rename(tmp.as_posix(), path.as_posix())
+    return stamp
+
+
+class LRU(object):
+    """
+    In-process backend, evicting the least recently used items.
+
+    The backend may be used from the threads serving requests, so access is serialized.
+    """
+    shared = False
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return None
+            self._items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+class FileBackend(object):
+    """
+    Backend storing items as files in a directory, evicting the least recently used files
+    when the total size exceeds `maxsize` bytes.
+
+    Reading a file updates its modification time, so the modification time is the time of
+    last use. Eviction removes files until a quarter of `maxsize` is free again.
+    """
+    shared = True
+
+    def __init__(self, directory, maxsize=100 * 1024 * 1024):
+        self.directory = Path(directory)
+        self.maxsize = maxsize
+        if not self.directory.exists():
+            self.directory.mkdir()
+        self.size = sum(size for _, _, size in self._files())
+
+    def _files(self):
+        for name in os.listdir(self.directory.as_posix()):
+            path = self.directory.joinpath(name)
+            if not name.endswith('.tmp'):
+                try:
+                    st = os.stat(path.as_posix())
+                except OSError:  # pragma: no cover
+                    # The file has been removed by another process.
+                    continue
+                yield path, st.st_mtime, st.st_size
+
+    def _path(self, key):
+        return self.directory.joinpath(sha1(key.encode('utf8')).hexdigest())
+
+    def __len__(self):
+        return len(list(self._files()))
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path.as_posix(), 'rb') as fp:
+                value = fp.read().decode('utf8')
+            os.utime(path.as_posix(), None)
+        except (IOError, OSError):
+            return None
+        return value
+
+    def set(self, key, value):
+        path, value = self._path(key), value.encode('utf8')
+        tmp = path.parent.joinpath('{0}.{1}.{2}.tmp'.format(
+            path.name, os.getpid(), threading.current_thread().ident))
+        with open(tmp.as_posix(), 'wb') as fp:
+            fp.write(value)
+        os.rename(tmp.as_posix(), path.as_posix())
+        self.size += len(value)
+        if self.size > self.maxsize:
+            self.evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path.as_posix())
+        except OSError:  # pragma: no cover
+            # The file has been removed by another process.
+            pass
+
+    def evict(self):
+        maxsize = self.maxsize * 3 // 4
+        # Other processes may have added or removed files, so we recompute the size:
+        files = sorted(self._files(), key=lambda f: f[1])
+        self.size = sum(size for _, _, size in files)
+        for path, _, size in files:
+            if self.size <= maxsize:
+                break
+            self._remove(path)
+            self.size -= size
+
+    def clear(self):
+        # We remove the files rather than the directory, which other processes write to.
+        for path, _, _ in list(self._files()):
+            self._remove(path)
+        self.size = 0
+
+
+class FragmentCache(object):
+    """
+    Cache of rendered fragments, counting hits and misses - from all threads, thus, the
+    counters are updated with a lock.
+
+    Keys are combined with the current data generation, so items of older generations
+    are never read again. When the generation changes, the backend is cleared - unless it
+    is shared with other processes, which may already have added items for the new
+    generation. Then, items of older generations are removed by eviction.
+    """
+    def __init__(self, backend, generation_path=GENERATION):
+        self.backend = backend
+        self.generation_path = generation_path
+        self.generation = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _key(self, key):
+        current = generation(self.generation_path)
+        if current != self.generation:
+            if self.generation is not None and not self.backend.shared:
+                self.backend.clear()
+            self.generation = current
+        return '{0}:{1}'.format(current, key)
+
+    def get(self, key, render):
+        """
+        :param render: Callable returning the fragment - called if it is not cached.
+        :return: The fragment for `key`.
+        """
+        key = self._key(key)
+        value = self.backend.get(key)
+        if value is None:
+            with self._lock:
+                self.misses += 1
+            value = render()
+            self.backend.set(key, value)
+        else:
+            with self._lock:
+                self.hits += 1
+        return value
+
+    def stats(self):
+        """
+        :return: `dict` with generation, size and counters of the cache.
+        """
+        return OrderedDict([
+            ('backend', self.backend.__class__.__name__),
+            ('generation', generation(self.generation_path)),
+            ('items', len(self.backend)),
+            ('hits', self.hits),
+            ('misses', self.misses),
+        ])
+
+
+def from_settings(settings):
+    """
+    Create a `FragmentCache` as configured by the app settings
+
+    - `dictionaria.cache`: `lru` (default), `file` or `none`,
+    - `dictionaria.cache_size`: Maximal number of items for `lru`, maximal number of bytes
+      for `file`,
+    - `dictionaria.cache_dir`: The directory for `file`.
+
+    :return: `FragmentCache` instance or `None`.
+    """
+    backend = settings.get('dictionaria.cache', 'lru')
+    size = settings.get('dictionaria.cache_size')
+    if backend == 'lru':
+        return FragmentCache(LRU(int(size or 1000)))
+    if backend == 'file':
+        return FragmentCache(FileBackend(
+            settings['dictionaria.cache_dir'], int(size or 100 * 1024 * 1024)))
+    if backend == 'none':
+        return None
+    raise ValueError('invalid dictionaria.cache: {0}'.format(backend))
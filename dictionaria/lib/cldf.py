@@ -1,16 +1,18 @@
 # coding: utf8
 from __future__ import unicode_literals, print_function, division
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, Counter
 import re
 from itertools import chain
 
 from pycldf import Dictionary as CldfDictionary
 from clldutils.misc import lazyproperty, nfilter
 from clld.db.models import common
-from clld.db.fts import tsvector
-from clld.db.meta import DBSession
 
-from dictionaria.lib.ingest import MeaningDescription, split, BaseDictionary
+from dictionaria.lib.ingest import (
+    MeaningDescription, split, BaseDictionary, FullText, report_matches,
+)
+from dictionaria.lib.concepts import get_matcher
+from dictionaria.lib.bulk import Row
 from dictionaria import models
 
 ASSOC_PATTERN = re.compile('rel_(?P<rel>[a-z]+)')
@@ -27,24 +29,52 @@ class Dictionary(BaseDictionary):
              vocab,
              lang,
              comparison_meanings,
-             labels):
+             labels,
+             writer):
+        """
+        Load the CLDF dataset, reading each table only once.
+
+        Since the full-text index of a word is made up of the rows of all tables, word
+        rows are staged - with pre-allocated primary keys - and only handed to the
+        writer once all tables have been read.
+        """
         def id_(oid):
             return '%s-%s' % (submission.id, oid)
 
+        def fulltext(row):
+            return ['{0}: {1}'.format(k, v) for k, v in row.items() if v]
+
+        def other(row, *keys):
+            return [
+                v for k, v in row.items() if k not in keys and not ASSOC_PATTERN.match(k)]
+
         metalanguages = submission.props.get('metalanguages', {})
+        words, fullentries, assocs = OrderedDict(), defaultdict(list), []
+        texts = defaultdict(FullText)
+        matches, matcher = Counter(), get_matcher()
+
         colmap = {k: self.cldf['EntryTable', k].name
                   for k in ['id', 'headword', 'partOfSpeech']}
         for lemma in self.cldf['EntryTable']:
+            fullentries[lemma[colmap['id']]].extend(fulltext(lemma))
+            texts[lemma[colmap['id']]].add('A', lemma[colmap['headword']])
+            texts[lemma[colmap['id']]].add('D', other(
+                lemma, colmap['id'], colmap['headword'], 'picture', 'image', 'sound', 'audio'))
             oid = lemma.pop(colmap['id'])
-            word = data.add(
-                models.Word,
-                oid,
+            word = words[oid] = Row(
+                pk=writer.pk(models.Word),
                 id=id_(oid),
                 name=lemma.pop(colmap['headword']),
                 pos=lemma.pop(colmap['partOfSpeech']),
-                dictionary=vocab,
-                language=lang)
-            DBSession.flush()
+                dictionary_pk=vocab.pk,
+                language_pk=lang.pk)
+            for key in lemma:
+                assoc = ASSOC_PATTERN.match(key)
+                if assoc:
+                    for lid in split(lemma.get(key, '')):
+                        # Note: we correct invalid references, e.g. "lx 13" and "Lx13".
+                        assocs.append((oid, lid.replace(' ', '').lower(), assoc.group('rel')))
+
             for attr, type_ in [('picture', 'image'), ('sound', 'audio')]:
                 fnames = lemma.pop(attr, None)
                 if fnames is None:
@@ -56,66 +86,65 @@ class Dictionary(BaseDictionary):
 
             for index, (key, value) in enumerate(lemma.items()):
                 if value:
-                    DBSession.add(common.Unit_data(
+                    writer.add(
+                        common.Unit_data,
                         object_pk=word.pk,
                         key=labels.get(key, key),
                         value=value,
-                        ord=index))
-
-        DBSession.flush()
+                        ord=index)
 
-        fullentries = defaultdict(list)
-        for lemma in self.cldf['EntryTable']:
-            fullentries[lemma[colmap['id']]].extend(list(lemma.items()))
-            word = data['Word'][lemma[colmap['id']]]
-            for key in lemma:
-                assoc = ASSOC_PATTERN.match(key)
-                if assoc:
-                    for lid in split(lemma.get(key, '')):
-                        # Note: we correct invalid references, e.g. "lx 13" and "Lx13".
-                        lid = lid.replace(' ', '').lower()
-                        DBSession.add(models.SeeAlso(
-                            source_pk=word.pk,
-                            target_pk=data['Word'][lid].pk,
-                            description=assoc.group('rel')))
+        for oid, lid, rel in assocs:
+            writer.add(
+                models.SeeAlso,
+                source_pk=words[oid].pk,
+                target_pk=words[lid].pk,
+                description=rel)
 
-        sense2word = {}
+        sense2word, meanings, valuesets = {}, {}, {}
         colmap = {k: self.cldf['SenseTable', k].name
                   for k in ['id', 'entryReference', 'description']}
         for sense in self.cldf['SenseTable']:
-            fullentries[sense[colmap['entryReference']]].extend(list(sense.items()))
-            sense2word[sense[colmap['id']]] = sense[colmap['entryReference']]
-            w = data['Word'][sense[colmap['entryReference']]]
+            wid = sense[colmap['entryReference']]
+            fullentries[wid].extend(fulltext(sense))
+            texts[wid].add('B', sense[colmap['description']], sense.get('alt_translation1'))
+            texts[wid].add('D', other(
+                sense, colmap['id'], colmap['entryReference'], colmap['description'],
+                'alt_translation1', 'picture', 'image', 'sound', 'audio'))
+            sense2word[sense[colmap['id']]] = wid
+            w = words[wid]
             kw = dict(
                 id=id_(sense[colmap['id']]),
                 name='; '.join(nfilter(sense[colmap['description']])),
-                word=w)
+                word_pk=w.pk)
             if 'alt_translation1' in sense and metalanguages.get('gxx'):
                 kw['alt_translation1'] = sense['alt_translation1']
                 kw['alt_translation_language1'] = metalanguages.get('gxx')
-            m = data.add(models.Meaning, sense[colmap['id']], **kw)
+            m = meanings[sense[colmap['id']]] = writer.add(models.Meaning, **kw)
 
             for i, md in enumerate(nfilter(sense[colmap['description']])):
-                key = md.lower()
-                if key in comparison_meanings:
-                    concept = comparison_meanings[key]
+                match = matcher.match(md)
+                if match and match[0] in comparison_meanings:
+                    concept = comparison_meanings[match[0]]
+                    matches[match[2]] += 1
                 else:
                     continue
 
                 vsid = '%s-%s' % (m.id, i)
-                vs = data['ValueSet'].get(vsid)
-                if not vs:
-                    vs = data.add(
-                        common.ValueSet, vsid,
+                if vsid not in valuesets:
+                    valuesets[vsid] = writer.add(
+                        common.ValueSet,
                         id=vsid,
-                        language=lang,
-                        contribution=vocab,
+                        language_pk=lang.pk,
+                        contribution_pk=vocab.pk,
                         parameter_pk=concept)
 
-                DBSession.add(models.Counterpart(
-                    id=vsid, name=w.name, valueset=vs, word=w))
+                writer.add(
+                    models.Counterpart,
+                    id=vsid,
+                    name=w.name,
+                    valueset_pk=valuesets[vsid].pk,
+                    word_pk=w.pk)
 
-            DBSession.flush()
             for attr, type_ in [('picture', 'image'), ('sound', 'audio')]:
                 fnames = sense.pop(attr, None)
                 if fnames is None:
@@ -131,13 +160,17 @@ class Dictionary(BaseDictionary):
         for ex in self.cldf['ExampleTable']:
             for mid in ex['Senses']:
                 if mid in sense2word:
-                    fullentries[sense2word[mid]].extend(list(ex.items()))
-                    models.MeaningSentence(
-                        meaning=data['Meaning'][mid],
-                        sentence=data['Example'][ex[colmap['id']]])
+                    fullentries[sense2word[mid]].extend(fulltext(ex))
+                    texts[sense2word[mid]].add(
+                        'C', ex[colmap['primaryText']], ex[colmap['translatedText']])
+                    writer.add(
+                        models.MeaningSentence,
+                        meaning_pk=meanings[mid].pk,
+                        sentence_pk=data['Example'][ex[colmap['id']]].pk)
                 else:
                     print('missing sense: {0}'.format(mid))
 
-        for wid, d in fullentries.items():
-            data['Word'][wid].fts = tsvector(
-                '; '.join('{0}: {1}'.format(k, v) for k, v in d if v))
+        for wid, word in words.items():
+            fullentry = '; '.join(fullentries[wid])
+            writer.add(models.Word, fts=texts[wid].weighted, serialized=fullentry, **word)
+        report_matches(matches)
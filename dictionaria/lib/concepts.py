@@ -0,0 +1,344 @@
+# coding: utf8
+"""
+Compact lookup of Concepticon concept sets by (lowercase) label.
+
+The labels from `static/concepticon-1.0-labels.json` are compiled into a binary file,
+which is memory-mapped - thus read lazily and shared read-only by all processes using
+it. The file consists of
+
+- a header: magic number, MD5 checksum of the JSON file it was built from, the number
+  of records and the number of slots of the hash table,
+- a hash table: the offsets of the records - plus 1, 0 marking empty slots - in slots
+  determined by the CRC-32 of their keys, with linear probing,
+- the records `<key>\\t<field>\\t...\\n`, UTF-8 encoded and sorted:
+  - `<label>\\t<conceptset ID>\\t<conceptset gloss>` for each label,
+  - `\\x01<key>\\t<conceptset ID>\\t<conceptset gloss>\\t<count>...` for each
+    normalized label (see `normalize`), listing the candidate concept sets - best first
+    - with the number of their labels with this normalization.
+
+The hash table is half empty, so looking up a key reads one or two slots on average.
+
+The file is built - and must be rebuilt, whenever the labels change - by running
+
+    python -m dictionaria.lib.concepts
+"""
+from __future__ import unicode_literals, print_function, division
+from hashlib import md5
+from collections import defaultdict
+import re
+import mmap
+import struct
+import zlib
+import os
+
+from clldutils.jsonlib import load
+from clldutils.path import Path
+
+__all__ = ['ConceptIndex', 'get_index', 'Matcher', 'get_matcher', 'normalize']
+
+MAGIC = b'DCL2'
+HEADER = struct.Struct('<4s16sII')
+OFFSET = struct.Struct('<I')
+NORMALIZED = '\x01'
+JSON = Path(__file__).parent.parent.joinpath('static', 'concepticon-1.0-labels.json')
+
+STOP_WORDS = ['to', 'a', 'an', 'the', 'be']
+PARENTHETICAL = re.compile(r'\([^)]*\)|\[[^\]]*\]')
+PUNCTUATION = re.compile(r"[^\w\s'-]", flags=re.UNICODE)
+LEADING_WORDS = re.compile(r'^(({0})\s+)+'.format('|'.join(STOP_WORDS)))
+
+
+def normalize(s):
+    """
+    Normalize a gloss by lowercasing and removing parentheticals, punctuation and leading
+    articles or "to", e.g. "To eat (sth.)." -> "eat".
+
+    :return: The normalized gloss, or `''` if only stop words - like "to" for \
+    "to (reach)" - are left.
+    """
+    s = PUNCTUATION.sub(' ', PARENTHETICAL.sub(' ', s.lower()))
+    s = LEADING_WORDS.sub('', ' '.join(s.split()))
+    return '' if all(w in STOP_WORDS for w in s.split()) else s
+
+
+# Plurals which cannot be reduced by stripping suffixes:
+IRREGULAR_PLURALS = {
+    'calves': 'calf',
+    'children': 'child',
+    'elves': 'elf',
+    'feet': 'foot',
+    'geese': 'goose',
+    'halves': 'half',
+    'hooves': 'hoof',
+    'knives': 'knife',
+    'leaves': 'leaf',
+    'lice': 'louse',
+    'lives': 'life',
+    'loaves': 'loaf',
+    'men': 'man',
+    'mice': 'mouse',
+    'oxen': 'ox',
+    'selves': 'self',
+    'sheaves': 'sheaf',
+    'shelves': 'shelf',
+    'teeth': 'tooth',
+    'thieves': 'thief',
+    'wives': 'wife',
+    'wolves': 'wolf',
+    'women': 'woman',
+}
+# Words ending in "s", which are not plurals:
+NOT_PLURALS = {'news', 'means', 'series', 'species', 'lens', 'gas', 'bus', 'yes'}
+
+
+def singulars(word):
+    """
+    :return: `list` of candidate singular forms of `word` - most likely first - or \
+    `[word]`.
+    """
+    if word in IRREGULAR_PLURALS:
+        return [IRREGULAR_PLURALS[word]]
+    if word in NOT_PLURALS:
+        return [word]
+    if len(word) > 4 and word.endswith('ies'):
+        return [word[:-3] + 'y']
+    if len(word) > 4 and word.endswith(('ches', 'shes', 'sses', 'xes', 'zzes')):
+        return [word[:-2]]
+    if len(word) > 3 and word.endswith('es'):
+        # "stones" -> "stone", but "buses" -> "bus", "potatoes" -> "potato"
+        return [word[:-1], word[:-2]]
+    if len(word) > 3 and word.endswith('s') and not word.endswith(('ss', 'us', 'is')):
+        return [word[:-1]]
+    return [word]
+
+
+def lemmatize(s):
+    """
+    Crude lemmatization of a normalized gloss: Nouns are reduced to the singular.
+
+    :return: `list` of candidate lemmas, most likely first, not including `s`.
+    """
+    res = ['']
+    for word in s.split():
+        res = [(r + ' ' + w).strip() for r in res for w in singulars(word)]
+    return [r for r in res if r != s]
+
+
+def slot(key, slots):
+    return (zlib.crc32(key) & 0xffffffff) % slots
+
+
+def checksum(path):
+    with open(path.as_posix(), 'rb') as fp:
+        return md5(fp.read()).digest()
+
+
+def build(json_path, path):
+    """
+    Compile the labels in `json_path` into a lookup file.
+
+    Labels of concept sets take precedence over alternative labels. If a normalized label
+    corresponds to more than one concept set, candidates are ranked: Concept sets with
+    matching gloss first, then concept sets with more matching labels.
+    """
+    data = load(json_path)
+    labels = dict(data['alternative_labels'])
+    labels.update(data['conceptset_labels'])
+    records, counts, glosses = [], defaultdict(lambda: defaultdict(int)), {}
+    for label, (cid, gloss) in labels.items():
+        records.append('\t'.join([label, cid, gloss]))
+        glosses[cid] = gloss
+        key = normalize(label)
+        if key:
+            counts[key][cid] += 1
+
+    for key, cids in counts.items():
+        fields = [NORMALIZED + key]
+        for cid in sorted(
+                cids, key=lambda c: (normalize(glosses[c]) != key, -cids[c], int(c))):
+            fields.extend([cid, glosses[cid], '{0}'.format(cids[cid])])
+        records.append('\t'.join(fields))
+    records = sorted((record + '\n').encode('utf8') for record in records)
+
+    slots = 2 * len(records) + 1
+    table, offset = [0] * slots, 0
+    for record in records:
+        i = slot(record[:record.index(b'\t')], slots)
+        while table[i]:
+            i = (i + 1) % slots
+        table[i] = offset + 1
+        offset += len(record)
+
+    tmp = path.parent.joinpath('{0}.{1}.tmp'.format(path.name, os.getpid()))
+    with open(tmp.as_posix(), 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, checksum(json_path), len(records), slots))
+        fp.write(struct.pack('<{0}I'.format(slots), *table))
+        for record in records:
+            fp.write(record)
+    os.rename(tmp.as_posix(), path.as_posix())
+
+
+class ConceptIndex(object):
+    """
+    Read-only, memory-mapped lookup file.
+    """
+    def __init__(self, path):
+        with open(path.as_posix(), 'rb') as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.checksum, self._n, self._slots = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError('invalid concept index: {0}'.format(path))
+        self._start = HEADER.size + OFFSET.size * self._slots - 1
+
+    def __len__(self):
+        return self._n
+
+    def _fields(self, key):
+        """
+        :return: `list` of the fields of the record for `key` or `None`.
+        """
+        key, mm, unpack = key.encode('utf8'), self._mmap, OFFSET.unpack_from
+        i = slot(key, self._slots)
+        while True:
+            offset = unpack(mm, HEADER.size + OFFSET.size * i)[0]
+            if not offset:
+                return None
+            start = self._start + offset
+            end = mm.find(b'\n', start)
+            tab = mm.find(b'\t', start, end)
+            if mm[start:tab] == key:
+                return mm[tab + 1:end].decode('utf8').split('\t')
+            i = (i + 1) % self._slots
+
+    def get(self, label, default=None):
+        """
+        :return: Pair `(conceptset ID, conceptset gloss)` for a lowercase label.
+        """
+        fields = self._fields(label)
+        return tuple(fields) if fields else default
+
+    def candidates(self, key):
+        """
+        :return: `list` of tuples `(conceptset ID, conceptset gloss, number of labels, \
+        total number of labels)` for a normalized label, best candidate first.
+        """
+        fields = self._fields(NORMALIZED + key)
+        if not fields:
+            return []
+        counts = [int(c) for c in fields[2::3]]
+        total = sum(counts)
+        return [
+            (cid, gloss, count, total)
+            for cid, gloss, count in zip(fields[0::3], fields[1::3], counts)]
+
+
+def index_path(json_path=JSON):
+    return json_path.parent.joinpath(json_path.stem + '.bin')
+
+
+_index = None
+
+
+def get_index(json_path=JSON):
+    """
+    :return: The `ConceptIndex` for the labels.
+    :raises ValueError: If the index is missing or has not been rebuilt after the labels \
+    have changed - which can only be checked if the labels are installed, too.
+    """
+    global _index
+    if _index is None:
+        path = index_path(json_path)
+        index = ConceptIndex(path) if path.exists() else None
+        if index is None or \
+                (json_path.exists() and index.checksum != checksum(json_path)):
+            raise ValueError(
+                'concept index {0} is missing or outdated, rebuild it running '
+                '"python -m dictionaria.lib.concepts"'.format(path))
+        _index = index
+    return _index
+
+
+class Matcher(object):
+    """
+    Matches glosses to Concepticon concept sets.
+
+    A gloss is matched - in this order - as exact label, as normalized label (see
+    `normalize`) or as lemmatized normalized label (see `lemmatize`) - which again may be
+    an exact label or a normalized label. The confidence of matches with normalized
+    labels is the share of the labels with this normalization, which belong to the concept
+    set.
+
+    Only matches with a confidence of at least `threshold` are accepted.
+    """
+    EXACT, NORMALIZED, LEMMATIZED = 'exact', 'normalized', 'lemmatized'
+    threshold = 0.8
+    cache_size = 100000
+
+    def __init__(self, index):
+        self.index = index
+        self._cache = {}
+
+    def _candidates(self, s):
+        """
+        :return: Generator of candidate matches `(conceptset ID, gloss, method, \
+        confidence)`, best first - with duplicate concept sets.
+        """
+        exact = self.index.get(s.lower())
+        if exact:
+            yield exact + (self.EXACT, 1.0)
+        key = normalize(s)
+        if not key:
+            return
+        for cid, gloss, count, total in self.index.candidates(key):
+            yield cid, gloss, self.NORMALIZED, count / total
+        for lemma in lemmatize(key):
+            exact = self.index.get(lemma)
+            if exact:
+                yield exact + (self.LEMMATIZED, 1.0)
+            for cid, gloss, count, total in self.index.candidates(lemma):
+                yield cid, gloss, self.LEMMATIZED, count / total
+
+    def ranked(self, s):
+        """
+        :return: `list` of candidate matches `(conceptset ID, gloss, method, confidence)`, \
+        best first.
+        """
+        res, seen = [], set()
+        for match in self._candidates(s):
+            if match[0] not in seen:
+                res.append(match)
+                seen.add(match[0])
+        return res
+
+    def match(self, s):
+        """
+        :return: The best match `(conceptset ID, gloss, method, confidence)` for a gloss, \
+        or `None` if there is no match with sufficient confidence.
+        """
+        try:
+            return self._cache[s]
+        except KeyError:
+            res = None
+            # Candidates are generated lazily, so we stop looking up at the first match:
+            for match in self._candidates(s):
+                if match[3] >= self.threshold:
+                    res = match
+                    break
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[s] = res
+            return res
+
+
+_matcher = None
+
+
+def get_matcher():
+    global _matcher
+    if _matcher is None:
+        _matcher = Matcher(get_index())
+    return _matcher
+
+
+if __name__ == '__main__':  # pragma: no cover
+    build(JSON, index_path(JSON))
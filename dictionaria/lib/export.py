@@ -0,0 +1,286 @@
+# coding: utf8
+"""
+Static bulk downloads of the dictionaries.
+
+For each dictionary, gzipped files are written to `static/download/`:
+
+- `<id>-entries.csv.gz`, `<id>-senses.csv.gz`, `<id>-examples.csv.gz` and
+  `<id>-media.csv.gz`: tables with the columns of the corresponding CLDF components,
+- `<id>-sources.bib.gz`: the sources in BibTeX format,
+- `<id>.jsonl.gz`: one JSON object per entry, with senses, examples, media and sources.
+
+Rows are read from server-side cursors and written while being read, so memory use
+does not depend on the size of a dictionary. The files are listed - with number of
+records, size and md5 checksum - in the manifest `static/download/index.json`.
+"""
+from __future__ import unicode_literals, print_function, division
+import gzip
+import datetime
+
+from sqlalchemy import text
+from clld.db.meta import DBSession
+from clldutils.dsv import UnicodeWriter
+from clldutils.jsonlib import load, dump
+from clldutils.path import Path, md5, remove
+from clldmpg.cdstar import SERVICE_URL
+
+import dictionaria
+from dictionaria.models import Dictionary, DictionarySource
+
+__all__ = ['DOWNLOAD_DIR', 'manifest', 'export']
+
+DOWNLOAD_DIR = Path(dictionaria.__file__).parent.joinpath('static', 'download')
+BATCH_SIZE = 1000
+
+# The URL of a file in CDSTAR, see `clldmpg.cdstar.bitstream_url`:
+URL = "(:bitstreams || (f.jsondata::json ->> 'objid') || '/' || " \
+      "(f.jsondata::json ->> 'original'))"
+
+MEDIA = """
+SELECT f.id, f.name, f.mime_type, {0} AS url
+FROM {{0}}_files AS f
+WHERE f.object_pk = {{1}}.pk
+ORDER BY f.pk""".format(URL)
+
+
+def as_list(sql):
+    return "(SELECT coalesce(json_agg(row_to_json(r)), '[]') FROM ({0}) AS r)".format(sql)
+
+
+TABLES = [
+    ('entries', [
+        'ID', 'Language_ID', 'Headword', 'Homonym_Number', 'Part_Of_Speech', 'Phonetic',
+        'Semantic_Domain', 'Comparison_Meanings', 'Comment', 'Media_IDs', 'Source'],
+     """
+SELECT
+  u.id, l.id, u.name, w.number, w.pos, w.phonetic, w.semantic_domain,
+  w.comparison_meanings, w.entry_comment,
+  (SELECT string_agg(f.id, ';' ORDER BY f.pk)
+   FROM unit_files AS f WHERE f.object_pk = w.pk),
+  (SELECT string_agg(
+     :prefix || s.id || coalesce('[' || nullif(r.description, '') || ']', ''),
+     ';' ORDER BY r.pk)
+   FROM wordreference AS r, source AS s WHERE r.word_pk = w.pk AND r.source_pk = s.pk)
+FROM word AS w, unit AS u, language AS l
+WHERE w.pk = u.pk AND u.language_pk = l.pk AND w.dictionary_pk = :pk
+ORDER BY w.pk"""),
+    ('senses', [
+        'ID', 'Entry_ID', 'Description', 'Gloss', 'Semantic_Domain',
+        'Alt_Translation1', 'Alt_Translation_Language1',
+        'Alt_Translation2', 'Alt_Translation_Language2', 'Example_IDs', 'Media_IDs'],
+     """
+SELECT
+  m.id, u.id, m.description, m.gloss, m.semantic_domain,
+  m.alt_translation1, m.alt_translation_language1,
+  m.alt_translation2, m.alt_translation_language2,
+  (SELECT string_agg(s.id, ';' ORDER BY s.pk)
+   FROM meaningsentence AS ms, sentence AS s
+   WHERE ms.meaning_pk = m.pk AND ms.sentence_pk = s.pk),
+  (SELECT string_agg(f.id, ';' ORDER BY f.pk)
+   FROM meaning_files AS f WHERE f.object_pk = m.pk)
+FROM meaning AS m, word AS w, unit AS u
+WHERE m.word_pk = w.pk AND w.pk = u.pk AND w.dictionary_pk = :pk
+ORDER BY w.pk, m.ord, m.pk"""),
+    ('examples', [
+        'ID', 'Language_ID', 'Primary_Text', 'Analyzed_Word', 'Gloss', 'Translated_Text',
+        'Alt_Translation1', 'Alt_Translation_Language1',
+        'Alt_Translation2', 'Alt_Translation_Language2', 'Source', 'Media_IDs'],
+     """
+SELECT
+  s.id, l.id, s.name, s.analyzed, s.gloss, s.description,
+  e.alt_translation1, e.alt_translation_language1,
+  e.alt_translation2, e.alt_translation_language2, s.source,
+  (SELECT string_agg(f.id, ';' ORDER BY f.pk)
+   FROM sentence_files AS f WHERE f.object_pk = s.pk)
+FROM example AS e, sentence AS s, language AS l
+WHERE e.pk = s.pk AND s.language_pk = l.pk AND e.dictionary_pk = :pk
+ORDER BY e.number, s.pk"""),
+    ('media', ['ID', 'Name', 'Media_Type', 'Download_URL'], """
+SELECT f.id, f.name, f.mime_type, {0}
+FROM (
+  SELECT f.* FROM unit_files AS f, word AS w
+  WHERE f.object_pk = w.pk AND w.dictionary_pk = :pk
+  UNION ALL
+  SELECT f.* FROM meaning_files AS f, meaning AS m, word AS w
+  WHERE f.object_pk = m.pk AND m.word_pk = w.pk AND w.dictionary_pk = :pk
+  UNION ALL
+  SELECT f.* FROM sentence_files AS f, example AS e
+  WHERE f.object_pk = e.pk AND e.dictionary_pk = :pk
+) AS f
+ORDER BY f.id""".format(URL)),
+]
+
+ENTRIES = """
+SELECT json_build_object(
+  'id', u.id,
+  'headword', u.name,
+  'homonym_number', w.number,
+  'part_of_speech', w.pos,
+  'phonetic', w.phonetic,
+  'comment', w.entry_comment,
+  'data', coalesce(wl.data, '{{}}'::jsonb),
+  'media', {media},
+  'sources', (
+    SELECT coalesce(json_agg(json_build_object(
+      'id', :prefix || s.id, 'context', r.description) ORDER BY r.pk), '[]')
+    FROM wordreference AS r, source AS s
+    WHERE r.word_pk = w.pk AND r.source_pk = s.pk),
+  'senses', (
+    SELECT coalesce(json_agg(json_build_object(
+      'id', m.id,
+      'description', m.description,
+      'gloss', m.gloss,
+      'semantic_domain', m.semantic_domain,
+      'alt_translation1', m.alt_translation1,
+      'alt_translation_language1', m.alt_translation_language1,
+      'alt_translation2', m.alt_translation2,
+      'alt_translation_language2', m.alt_translation_language2,
+      'media', {meaning_media},
+      'examples', (
+        SELECT coalesce(json_agg(json_build_object(
+          'id', s.id,
+          'primary_text', s.name,
+          'analyzed_word', s.analyzed,
+          'gloss', s.gloss,
+          'translated_text', s.description,
+          'source', s.source) ORDER BY s.pk), '[]')
+        FROM meaningsentence AS ms, sentence AS s
+        WHERE ms.meaning_pk = m.pk AND ms.sentence_pk = s.pk)
+    ) ORDER BY m.ord, m.pk), '[]')
+    FROM meaning AS m
+    WHERE m.word_pk = w.pk)
+)::text
+FROM word AS w
+  JOIN unit AS u ON w.pk = u.pk
+  LEFT OUTER JOIN wordlisting AS wl ON wl.pk = w.pk
+WHERE w.dictionary_pk = :pk
+ORDER BY w.pk""".format(
+    media=as_list(MEDIA.format('unit', 'w')),
+    meaning_media=as_list(MEDIA.format('meaning', 'm')))
+
+
+def stream(sql, **params):
+    """
+    :return: Result of a query, fetching rows in batches from a server-side cursor.
+    """
+    params.setdefault('bitstreams', SERVICE_URL.path('bitstreams/').as_string())
+    return DBSession.connection().execution_options(stream_results=True)\
+        .execute(text(sql), **params)
+
+
+def csv_chunks(header, rows):
+    """
+    :return: Generator of UTF-8 encoded CSV chunks.
+    """
+    batch = [header]
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            yield csv_chunk(batch)
+            batch = []
+    if batch:
+        yield csv_chunk(batch)
+
+
+def csv_chunk(rows):
+    with UnicodeWriter() as writer:
+        writer.writerows(rows)
+        return writer.read()
+
+
+def write(path, chunks, records):
+    """
+    Write chunks of bytes to a gzipped file.
+
+    :param records: `Counter` of the records passed into the chunks.
+    :return: `dict` describing the file for the manifest.
+    """
+    # With fixed mtime, the file - and its checksum - only changes if the data changes.
+    with gzip.GzipFile(path.as_posix(), 'wb', mtime=0) as fp:
+        for chunk in chunks:
+            fp.write(chunk)
+    return dict(
+        name=path.name, records=records.count, size=path.stat().st_size, md5=md5(path))
+
+
+class Counter(object):
+    """
+    Counts the items of an iterable while passing them on.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, items):
+        for item in items:
+            self.count += 1
+            yield item
+
+
+def export_dictionary(d, outdir):
+    """
+    Write the downloads of a dictionary.
+
+    :return: `list` of `dict`s describing the files.
+    """
+    params = dict(pk=d.pk, prefix='{0}-'.format(d.id))
+    files = []
+    for name, header, sql in TABLES:
+        records = Counter()
+        files.append(write(
+            outdir.joinpath('{0}-{1}.csv.gz'.format(d.id, name)),
+            csv_chunks(header, records(stream(sql, **params))),
+            records))
+
+    records = Counter()
+    sources = DBSession.query(DictionarySource)\
+        .filter(DictionarySource.dictionary_pk == d.pk)\
+        .order_by(DictionarySource.pk)\
+        .yield_per(BATCH_SIZE)
+    files.append(write(
+        outdir.joinpath('{0}-sources.bib.gz'.format(d.id)),
+        ('{0}\n\n'.format(src.bibtex()).encode('utf8') for src in records(sources)),
+        records))
+
+    records = Counter()
+    entries = records(stream(ENTRIES, **params))
+    files.append(write(
+        outdir.joinpath('{0}.jsonl.gz'.format(d.id)),
+        ('{0}\n'.format(row[0]).encode('utf8') for row in entries),
+        records))
+    return files
+
+
+def manifest(outdir=DOWNLOAD_DIR):
+    """
+    :return: `dict` mapping dictionary IDs to `dict`s with the dictionary name, the time \
+    of the export and a list of files.
+    """
+    path = outdir.joinpath('index.json')
+    return load(path) if path.exists() else {}
+
+
+def export(dpks=None, outdir=DOWNLOAD_DIR):
+    """
+    Write the downloads of dictionaries and update the manifest.
+
+    :param dpks: `list` of pks of the dictionaries to export, or `None` to export all.
+    """
+    if not outdir.exists():
+        outdir.mkdir()
+    index = manifest(outdir)
+    ids = set()
+    for d in DBSession.query(Dictionary).order_by(Dictionary.id):
+        ids.add(d.id)
+        if dpks is None or d.pk in dpks:
+            print('exporting %s ...' % d.id)
+            index[d.id] = dict(
+                name=d.name,
+                updated=datetime.datetime.utcnow().isoformat(),
+                files=export_dictionary(d, outdir))
+
+    # Remove the downloads of dictionaries which have been removed:
+    for id_ in set(index) - ids:
+        for spec in index.pop(id_)['files']:
+            if outdir.joinpath(spec['name']).exists():
+                remove(outdir.joinpath(spec['name']))
+    dump(index, outdir.joinpath('index.json'), indent=2)
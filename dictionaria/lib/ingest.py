@@ -1,5 +1,5 @@
 # coding: utf8
-from __future__ import unicode_literals
+from __future__ import unicode_literals, print_function
 from hashlib import md5
 from collections import OrderedDict, defaultdict
 import re
@@ -7,40 +7,74 @@ import re
 from clld.db.models import common
 from clld.db.meta import DBSession
 from clldutils.dsv import reader
-from clldutils.sfm import SFM, Entry
-from clldutils.misc import cached_property, slug, UnicodeMixin
-from clldutils.path import Path
-from clldutils.jsonlib import load
+from clldutils.sfm import Entry
+from clldutils.misc import slug, UnicodeMixin
 from clldutils.text import split_text
 
-import dictionaria
 from dictionaria import models
+from dictionaria.lib.concepts import get_matcher
 
 
 def split(s, sep=';'):
     return split_text(s, separators=sep, brackets={}, strip=True)
 
-_concepticon = None
+MARKUP = [
+    (re.compile(r'\[([^\]]*)\]\([^)]*\)'), r'\1'),  # Markdown links
+    (re.compile(r'<[^>]+>'), ' '),  # HTML tags
+    (re.compile(r'\|[a-z]{1,3}\{([^}]*)\}'), r'\1'),  # SFM inline formatting
+    (re.compile(r'(^|\s)\\[A-Za-z_]+(?=\s|$)'), ' '),  # SFM markers
+]
 
 
-def get_concept(s):
-    global _concepticon
-    if _concepticon is None:
-        _concepticon = load(Path(dictionaria.__file__).parent.joinpath(
-            'static', 'concepticon-1.0-labels.json'))
-    s = s.lower()
-    if s in _concepticon['conceptset_labels']:
-        return _concepticon['conceptset_labels'][s]
-    return _concepticon['alternative_labels'].get(s)
+def strip_markup(s):
+    for pattern, repl in MARKUP:
+        s = pattern.sub(repl, s)
+    return ' '.join(s.split())
+
+
+class FullText(object):
+    """
+    The text of a word to be indexed for full-text search, in parts labelled with the
+    weight in the index: A for the headword, B for meaning descriptions and glosses, C for
+    examples and D for anything else.
+    """
+    def __init__(self):
+        self.parts = OrderedDict((weight, []) for weight in 'ABCD')
+
+    def add(self, weight, *values):
+        for value in values:
+            if isinstance(value, (list, tuple)):
+                self.add(weight, *value)
+            elif value:
+                value = strip_markup('{0}'.format(value))
+                if value:
+                    self.parts[weight].append(value)
+
+    def add_example(self, ex):
+        """
+        :param ex: `models.Example` - or `Row` - to add text and translations of.
+        """
+        self.add(
+            'C',
+            *[getattr(ex, attr, None) for attr in
+              ['name', 'description', 'alt_translation1', 'alt_translation2']])
+
+    @property
+    def weighted(self):
+        """
+        :return: `dict` mapping weights to text - as accepted by the writers for \
+        `TSVECTOR` columns.
+        """
+        return {weight: ' '.join(values) for weight, values in self.parts.items()}
 
 
 class ComparisonMeaning(UnicodeMixin):
     def __init__(self, s):
         self.id = None
         self.label = None
-        cid = get_concept(s)
-        if cid:
-            self.id, self.label = cid
+        match = get_matcher().match(s)
+        if match:
+            self.id, self.label = match[:2]
 
     def __unicode__(self):
         if self.id:
@@ -166,16 +200,13 @@ class Example(Entry):
         return '\n'.join('\\' + l for l in lines)
 
 
-class Examples(SFM):
-    def read(self, filename, **kw):
-        return SFM.read(self, filename, entry_impl=Example, **kw)
-
-    @cached_property()
-    def _map(self):
-        return {entry.get('ref'): entry for entry in self}
-
-    def get(self, item):
-        return self._map.get(item)
+def report_matches(counts):
+    """
+    Print the number of counterparts by method of matching the comparison meaning.
+    """
+    if counts:
+        print('counterparts by comparison meaning match: {0}'.format(', '.join(
+            '{0} {1}'.format(n, method) for method, n in sorted(counts.items()))))
 
 
 class BaseDictionary(object):
@@ -192,5 +223,12 @@ class BaseDictionary(object):
             vocab,
             lang,
             comparison_meanings,
-            labels):
+            labels,
+            writer):
+        """
+        Load the dictionary data into the database.
+
+        :param writer: `dictionaria.lib.bulk.SessionWriter` instance, used to persist \
+        new rows.
+        """
         raise NotImplementedError
@@ -0,0 +1,118 @@
+# coding: utf8
+"""
+The catalogue of media files in CDSTAR, i.e. the file specs in `cdstar.json`, keyed by
+md5 checksum.
+"""
+from __future__ import unicode_literals, print_function
+from collections import OrderedDict, defaultdict
+import binascii
+
+from clldutils.jsonlib import load
+
+__all__ = ['Catalogue', 'get_catalogue', 'Files']
+
+
+def key(checksum):
+    """
+    :return: The 16 byte digest for an md5 hex checksum, other strings unchanged.
+    """
+    if len(checksum) == 32:
+        try:
+            return binascii.unhexlify(checksum)
+        except (TypeError, ValueError):
+            pass
+    return checksum
+
+
+class Catalogue(object):
+    """
+    Compact, read-only index of file specs by checksum.
+
+    Checksums are stored as digests, and specs as tuples of values - sharing one tuple of
+    keys among all specs with the same keys.
+    """
+    def __init__(self, specs):
+        fields, self._specs = {}, {}
+        for checksum, spec in specs.items():
+            keys = tuple(sorted(spec))
+            keys = fields.setdefault(keys, keys)
+            self._specs[key(checksum)] = (keys, tuple(spec[k] for k in keys))
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(load(path))
+
+    def __len__(self):
+        return len(self._specs)
+
+    def __contains__(self, checksum):
+        return key(checksum) in self._specs
+
+    def get(self, checksum, default=None):
+        """
+        :return: `dict` with the spec of the file with md5 checksum `checksum`.
+        """
+        res = self._specs.get(key(checksum))
+        return dict(zip(*res)) if res else default
+
+
+_catalogues = {}
+
+
+def get_catalogue(path):
+    """
+    :return: The `Catalogue` read from `path` - loaded once per process.
+    """
+    if path.as_posix() not in _catalogues:
+        _catalogues[path.as_posix()] = Catalogue.from_file(path)
+    return _catalogues[path.as_posix()]
+
+
+class Files(object):
+    """
+    Collects the media files attached to objects while loading a submission.
+
+    Files are registered once per object and checksum, and written with `flush`, after
+    all objects have been added.
+    """
+    def __init__(self, catalogue, props=None):
+        self.catalogue = catalogue
+        self.props = props or {}
+        self.rows = OrderedDict()
+        self.missing = defaultdict(set)
+
+    def add(self, type_, checksum, file_cls, obj):
+        """
+        :param type_: `audio` or `image`.
+        :param file_cls: The `FilesMixin` class to add a row of.
+        :param obj: The object - with `id` and `pk` - the file is attached to.
+        """
+        key_ = (file_cls, obj.pk, checksum)
+        if key_ in self.rows:
+            return
+        spec = self.catalogue.get(checksum)
+        if not spec:
+            self.missing[type_].add(checksum)
+            return
+        jsondata = {k: v for k, v in self.props.get(type_, {}).items()}
+        jsondata.update(spec)
+        self.rows[key_] = dict(
+            id='%s-%s' % (obj.id, checksum),
+            name=spec['original'],
+            object_pk=obj.pk,
+            mime_type=spec['mimetype'],
+            jsondata=jsondata)
+
+    def flush(self, writer):
+        for (file_cls, _, _), kw in self.rows.items():
+            writer.add(file_cls, **kw)
+        self.rows = OrderedDict()
+
+    def report(self, limit=10):
+        for type_, checksums in sorted(self.missing.items()):
+            checksums = sorted(checksums)
+            print('{0} {1} files missing: {2}{3}'.format(
+                len(checksums),
+                type_,
+                ', '.join(checksums[:limit]),
+                ', ...' if len(checksums) > limit else ''))
@@ -3,18 +3,20 @@
 Parsing functionality for the SFM variant understood for Dictionaria submissions.
 """
 from __future__ import unicode_literals, print_function
-from collections import defaultdict
+from collections import defaultdict, Counter
 import re
+import io
+import os
 from copy import copy
 
 from clld.db.models import common
-from clld.db.fts import tsvector
-from clld.db.meta import DBSession
 
 from clldutils import sfm
-from clldutils.misc import cached_property
 
-from dictionaria.lib.ingest import MeaningDescription, split, BaseDictionary
+from dictionaria.lib.ingest import (
+    MeaningDescription, split, BaseDictionary, FullText, report_matches,
+)
+from dictionaria.lib.concepts import get_matcher
 from dictionaria import models
 
 
@@ -42,6 +44,8 @@ class Meaning(object):
 
     Semantic domain and examples are also meaning specific.
     """
+    __slots__ = ('de', 'ge', 'gxx', 'gxy', 're', 'sd', 'xref')
+
     def __init__(self):
         self.de = None
         self.ge = None
@@ -52,18 +56,23 @@ class Meaning(object):
         self.xref = []
 
 
+HOMONYM_NUMBER = re.compile('(?P<number>[0-9]+)')
+
+
 class Word(object):
     """
     A word is the atomic language unit in dictionaria.
 
     A dictionary entry may contain multiple words via sub-entry markers.
     """
+    __slots__ = ('form', '_hm', 'ph', '_ps', 'data', 'rel', 'meanings')
+
     def __init__(self, form):
         self.form = form
         self._hm = 0  # homonym marker
         self.ph = None  # phonetic representation of the word
         self._ps = None  # part-of-speech
-        self.data = defaultdict(list)  # to store additional marker, value pairs
+        self.data = {}  # to store additional marker, value pairs
         self.rel = []
         self.meanings = []
 
@@ -84,15 +93,15 @@ class Word(object):
 
     @hm.setter
     def hm(self, value):
-        m = re.search('(?P<number>[0-9]+)', value)
+        m = HOMONYM_NUMBER.search(value)
         self._hm = int(m.group('number')) if m else 0
 
     def copy(self):
         w = Word(self.form)
         w.ph = self.ph
-        if not self.hm:
-            self.hm = '1'
-        w.hm = '{0}'.format(int(self.hm) + 1)
+        if not self._hm:
+            self._hm = 1
+        w._hm = self._hm + 1
         w.data = copy(self.data)
         return w
 
@@ -101,6 +110,13 @@ class Word(object):
         return self.form + (self.hm or '')
 
 
+# Markers which are not indexed for full-text search - either because they hold
+# meta-data, or because their values are indexed with a specific weight:
+FTS_SKIP_MARKERS = {
+    'lx', 'se', 'de', 'ge', 'gxx', 'gxy', 're', 'sn', 'hm', 'lxid', 'xref', 'bibref', 'dt',
+    'sf', 'pc', 'comparison_meanings',
+}
+
 RELATION_MAP = {
     'cf': 'see also',
     'mn': 'main entry',
@@ -109,6 +125,111 @@ RELATION_MAP = {
 }
 
 
+class WordParser(object):
+    """
+    State of the split of an entry into words.
+
+    The (marker, value) pairs of the entry are passed to the handler for the marker - as
+    looked up in `dispatch` - which returns a completed word or `None`.
+    """
+    __slots__ = ('entry', 'word', 'meaning', 'pos', 'first_meaning', 'sn_is_se')
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.word = None
+        # if an entry has only one \ps marker but multiple words, the value of \ps is used
+        # as part-of-speech for all words.
+        self.pos = None
+        self.meaning = None
+        # flag signaling whether we are dealing with the first meaning of a word or
+        # subsequent ones.
+        self.first_meaning = True
+        self.sn_is_se = False
+
+    def new_word(self, k, v):
+        # individual words are identified by \lx or \se (sub-entry) markers.
+        res = None
+        if self.word:
+            res = self.entry.checked_word(self.word, self.meaning, self.pos)
+        self.word = Word(v)
+        self.meaning = Meaning()
+        return res
+
+    def new_meaning(self, k, v):
+        # a new sense number: initialize a new Meaning.
+        word = self.word
+        if not word._hm:
+            word.hm = v
+        if self.first_meaning:
+            # determine whether we are dealing with the case where \ps comes after
+            # \sn, thus, \sn has to be treated like \se:
+            self.sn_is_se = not bool(self.pos)
+            self.first_meaning = False
+            return
+        self.entry.checked_word(word, self.meaning, self.pos)
+        self.meaning = Meaning()
+        if self.sn_is_se and word.form:
+            self.word = word.copy()
+            return word
+
+    def meaning_attr(self, k, v):
+        # FIXME: we must support multiple meanings expressed by
+        # semicolon-separated \ge values, e.g. "jump ; jump at"
+        setattr(self.meaning, k, v)
+
+    def semantic_domain(self, k, v):
+        self.meaning.sd.append(v)
+
+    def example(self, k, v):
+        self.meaning.xref.append(v)
+
+    def word_attr(self, k, v):
+        if getattr(self.word, k) is None:
+            # only record first occurrence of the marker!
+            setattr(self.word, k, v)
+
+    def part_of_speech(self, k, v):
+        self.pos = v
+        word = self.word
+        try:
+            word.ps = v
+        except ValueError:
+            self.entry.checked_word(word, self.meaning, v)
+            self.meaning = Meaning()
+            if word.form:
+                self.word = word.copy()
+                self.word.ps = v
+                return word
+
+    def relation(self, k, v):
+        self.word.rel.extend([(RELATION_MAP[k], vv.strip()) for vv in split(v, ',')])
+
+    def datum(self, k, v):
+        data = self.word.data
+        if k in data:
+            data[k].append(v)
+        else:
+            data[k] = [v]
+
+
+WordParser.dispatch = {
+    'lx': WordParser.new_word,
+    'se': WordParser.new_word,
+    'sn': WordParser.new_meaning,
+    'de': WordParser.meaning_attr,
+    'ge': WordParser.meaning_attr,
+    're': WordParser.meaning_attr,
+    'gxx': WordParser.meaning_attr,
+    'gxy': WordParser.meaning_attr,
+    'sd': WordParser.semantic_domain,
+    'xref': WordParser.example,
+    'hm': WordParser.word_attr,
+    'ph': WordParser.word_attr,
+    'ps': WordParser.part_of_speech,
+}
+WordParser.dispatch.update({k: WordParser.relation for k in RELATION_MAP})
+
+
 class Entry(sfm.Entry):
     """
     A dictionary entry.
@@ -136,87 +257,71 @@ class Entry(sfm.Entry):
         """
         :return: generator for the words contained within the entry.
         """
-        word = None
-        # if an entry has only one \ps marker but multiple words, the value of \ps is used
-        # as part-of-speech for all words.
-        pos = None
-
-        meaning = None
-
-        # flag signaling whether we are dealing with the first meaning of a word or
-        # subsequent ones.
-        first_meaning = True
-        sn_is_se = False
+        parser = WordParser(self)
+        dispatch, default = WordParser.dispatch, WordParser.datum
 
         # now we loop over the (marker, value) pairs of the entry:
         for k, v in self:
-            # individual words are identified by \lx or \se (sub-entry) markers.
-            if k in ['lx', 'se']:
-                if word:
-                    yield self.checked_word(word, meaning, pos)
-                word = Word(v)
-                meaning = Meaning()
-            elif k == 'sn':  # a new sense number: initialize a new Meaning.
-                word.hm = word.hm or v
-                if first_meaning:
-                    # determine whether we are dealing with the case where \ps comes after
-                    # \sn, thus, \sn has to be treated like \se:
-                    sn_is_se = not bool(pos)
-                    first_meaning = False
-                else:
-                    self.checked_word(word, meaning, pos)
-                    if sn_is_se and word.form:
-                        yield word
-                        word = word.copy()
-                    meaning = Meaning()
-            # meaning-specific markers:
-            elif k in ['de', 'ge', 're', 'gxx', 'gxy']:
-                # FIXME: we must support multiple meanings expressed by
-                # semicolon-separated \ge values, e.g. "jump ; jump at"
-                setattr(meaning, k, v)
-            elif k == 'sd':
-                meaning.sd.append(v)
-            elif k == 'xref':
-                meaning.xref.append(v)
-            # word-specific markers:
-            elif k in ['hm', 'ph']:
-                if getattr(word, k) is None:
-                    # only record first occurrence of the marker!
-                    setattr(word, k, v)
-            elif k == 'ps':
-                pos = v
-                try:
-                    word.ps = v
-                except ValueError:
-                    self.checked_word(word, meaning, pos)
-                    if word.form:
-                        yield word
-                        word = word.copy()
-                        word.ps = v
-                    meaning = Meaning()
-            elif k in RELATION_MAP:
-                word.rel.extend([(RELATION_MAP[k], vv.strip()) for vv in split(v, ',')])
+            word = dispatch.get(k, default)(parser, k, v)
+            if word is not None:
+                yield word
+        if parser.word and parser.word.form:
+            yield self.checked_word(parser.word, parser.meaning, parser.pos)
+
+
+def iter_entries(
+        path, entry_impl=Entry, entry_sep='\\lx ', entry_prefix='\\lx ', encoding='utf-8'):
+    """
+    Read the entries of an SFM file incrementally.
+
+    Entries are parsed as with `clldutils.sfm.SFM.from_file`, but yielded one at a time
+    while reading the file line by line, so memory use does not depend on the file size.
+    `entry_sep` may be a string contained in a line, or `\\n\\n` - i.e. entries are
+    separated by empty lines.
+    """
+    def entry(lines):
+        block = ''.join(lines)
+        if block.strip():
+            return entry_impl([
+                (k, v.strip()) for k, v in
+                sfm.marker_split(((entry_prefix or '') + block).strip()) if v.strip()])
+
+    with io.open(path.as_posix(), 'r', encoding=encoding, newline=None) as fp:
+        lines = []
+        for line in fp:
+            if entry_sep == '\n\n':
+                parts = ['', ''] if line == '\n' else [line]
             else:
-                word.data[k].append(v)
-        if word and word.form:
-            yield self.checked_word(word, meaning, pos)
+                parts = line.split(entry_sep)
+            lines.append(parts[0])
+            for part in parts[1:]:
+                e = entry(lines)
+                if e:
+                    yield e
+                lines = [part]
+        e = entry(lines)
+        if e:
+            yield e
 
 
 class Dictionary(BaseDictionary):
-    @cached_property()
+    @property
     def sfm(self):
-        return sfm.SFM.from_file(
-            self.dir.joinpath('db.sfm'),
-            entry_sep='\\lx ',
-            entry_prefix='\\lx ',
-            entry_impl=Entry)
+        """
+        :return: Generator of the entries in `db.sfm`.
+        """
+        return iter_entries(self.dir.joinpath('db.sfm'))
 
     def concepticon(self, db):
         visitor = Concepticon()
-        self.sfm.visit(visitor)
-        print('Found comparison meanings for %s of %s entries' % (
-            visitor.count, len(self.sfm)))
-        self.sfm.write(db)
+        tmp = db.parent.joinpath(db.name + '.tmp')
+        n = 0
+        with io.open(tmp.as_posix(), 'w', encoding='utf-8') as fp:
+            for n, entry in enumerate(self.sfm, start=1):
+                fp.write((visitor(entry) or entry).__unicode__())
+                fp.write('\n\n')
+        os.rename(tmp.as_posix(), db.as_posix())
+        print('Found comparison meanings for %s of %s entries' % (visitor.count, n))
 
     def load(
             self,
@@ -225,16 +330,24 @@ class Dictionary(BaseDictionary):
             vocab,
             lang,
             comparison_meanings,
-            labels):
+            labels,
+            writer):
         rel = []
         skipped = []
         words_by_lemma = defaultdict(list)
+        valuesets = {}
+        counterparts = set()
+        matches, matcher = Counter(), get_matcher()
+        metalanguages = submission.props.get('metalanguages', {})
+        match_comparison_meanings = submission.props.get(
+            'match_comparison_meanings', False)
 
         def meaning_descriptions(s):
             return split((s or '').replace('.', ' ').lower())
 
         wids = set()
         for i, entry in enumerate(self.sfm):
+            writer.checkpoint()
             words = list(entry.get_words())
             headword = None
 
@@ -246,10 +359,16 @@ class Dictionary(BaseDictionary):
                     continue
 
                 examples = []
+                text = FullText()
+                text.add('A', word.form)
                 for meaning in word.meanings:
+                    text.add('B', meaning.de, meaning.ge, meaning.gxx, meaning.gxy, meaning.re)
                     for xref in meaning.xref:
                         if xref in data['Example']:
                             examples.append(data['Example'][xref].serialized)
+                            text.add_example(data['Example'][xref])
+                text.add('D', [v for k, v in entry if k not in FTS_SKIP_MARKERS])
+                text.add('D', [v for k, v in entry if k in ['lx', 'se'] and v != word.form])
 
                 wid = '%s-%s-%s' % (submission.id, i + 1, j + 1)
                 # Recognize and keep \lxid as local entry ID
@@ -262,19 +381,18 @@ class Dictionary(BaseDictionary):
                     #else:
                     #    print(submission.id, entry.get('lxid'))
                 fullentry = '{0}\n{1}'.format(entry, '\n'.join(examples))
-                w = data.add(
+                w = writer.add(
                     models.Word,
-                    word.id,
                     id=wid,
                     name=word.form,
                     entry_comment=word.data.get('links', [None]).pop(),
                     number=int(word.hm) if word.hm and word.hm != '-' else 0,
                     phonetic=word.ph,
                     pos=word.ps,
-                    fts=tsvector(fullentry),
+                    fts=text.weighted,
                     serialized=fullentry,
-                    dictionary=vocab,
-                    language=lang)
+                    dictionary_pk=vocab.pk,
+                    language_pk=lang.pk)
 
                 seen = set()
                 for bibref in entry.getall('bibref'):
@@ -287,10 +405,11 @@ class Dictionary(BaseDictionary):
                         continue
                     seen.add((key, context))
                     if key in data['DictionarySource']:
-                        DBSession.add(models.WordReference(
-                            source=data['DictionarySource'][key],
-                            word=w,
-                            description=labels.get(context, context)))
+                        writer.add(
+                            models.WordReference,
+                            source_pk=data['DictionarySource'][key].pk,
+                            word_pk=w.pk,
+                            description=labels.get(context, context))
 
                 if not headword:
                     headword = word.id
@@ -305,7 +424,6 @@ class Dictionary(BaseDictionary):
                     words_by_lemma['{0} {1}'.format(word.form, word.hm)].append(w)
                 if wid not in words_by_lemma:
                     words_by_lemma[wid].append(w)
-                DBSession.flush()
 
                 for md5, type_ in set(entry.files):
                     submission.add_file(type_, md5, common.Unit_files, w)
@@ -319,18 +437,19 @@ class Dictionary(BaseDictionary):
                     if meaning.ge:
                         meaning.ge = meaning.ge.replace('.', ' ')
 
-                    m = models.Meaning(
+                    m = writer.add(
+                        models.Meaning,
                         id='%s-%s' % (w.id, k + 1),
                         name=meaning.de or meaning.ge,
                         description=meaning.de,
                         gloss=meaning.ge,
                         reverse=meaning.re,
                         alt_translation1=meaning.gxx,
-                        alt_translation_language1=submission.props.get('metalanguages', {}).get('gxx'),
+                        alt_translation_language1=metalanguages.get('gxx'),
                         alt_translation2=meaning.gxy,
-                        alt_translation_language2=submission.props.get('metalanguages', {}).get('gxy'),
+                        alt_translation_language2=metalanguages.get('gxy'),
                         #ord=k + 1,
-                        word=w,
+                        word_pk=w.pk,
                         semantic_domain=', '.join(meaning.sd))
 
                     for xref in meaning.xref:
@@ -338,62 +457,72 @@ class Dictionary(BaseDictionary):
                         if s is None:
                             print('missing example referenced: %s' % xref)
                         else:
-                            models.MeaningSentence(meaning=m, sentence=s)
+                            writer.add(
+                                models.MeaningSentence,
+                                meaning_pk=m.pk,
+                                sentence_pk=s.pk)
 
                 #
-                # Lookup comparison meanings.
+                # Lookup comparison meanings: Curated ones - from \zcom2 - or, if the
+                # submission opts in with the property "match_comparison_meanings",
+                # matches of the meaning descriptions.
                 #
-                for m in re.finditer('\[(?P<id>[0-9]+)\]', entry.get('zcom2', '')):
-                    cid = m.group('id')
+                cids = [(m.group('id'), 'curated') for m in
+                        re.finditer('\[(?P<id>[0-9]+)\]', entry.get('zcom2', ''))]
+                if not cids and match_comparison_meanings:
+                    for meaning in word.meanings:
+                        for md in split(meaning.de or ''):
+                            match = matcher.match(md)
+                            if match and match[0] in comparison_meanings:
+                                cids.append((match[0], match[2]))
+
+                for cid, method in cids:
                     vsid = '%s-%s' % (submission.id, cid)
-                    if vsid in data['ValueSet']:
-                        vs = data['ValueSet'][vsid]
-                    else:
-                        vs = data.add(
+                    if vsid not in valuesets:
+                        valuesets[vsid] = writer.add(
                             common.ValueSet,
-                            vsid,
                             id=vsid,
-                            language=lang,
-                            contribution=vocab,
+                            language_pk=lang.pk,
+                            contribution_pk=vocab.pk,
                             parameter_pk=comparison_meanings[cid])
 
                     vid = '%s-%s' % (vsid, w.id)
-                    if vid not in data['Counterpart']:
-                        data.add(
+                    if vid not in counterparts:
+                        counterparts.add(vid)
+                        matches[method] += 1
+                        writer.add(
                             models.Counterpart,
-                            vid,
                             id=vid,
                             name=w.name,
-                            valueset=vs,
-                            word=w)
+                            valueset_pk=valuesets[vsid].pk,
+                            word_pk=w.pk)
 
                 for index, (key, label) in enumerate(labels.items()):
                     if key in word.data:
                         for value in word.data[key]:
-                            DBSession.add(common.Unit_data(
-                                object_pk=w.pk, key=labels[key], value=value, ord=index))
+                            writer.add(
+                                common.Unit_data,
+                                object_pk=w.pk,
+                                key=labels[key],
+                                value=value,
+                                ord=index)
 
                 for key, value in word.data.items():
                     if key.endswith('_links'):
                         nkey = key.replace('_links', '')
                         for i, value in enumerate(word.data[key]):
-                            DBSession.add(common.Unit_data(
+                            writer.add(
+                                common.Unit_data,
                                 object_pk=w.pk,
                                 key=(labels[nkey] + '_links') if nkey in labels else key,
                                 value=value,
-                                ord=i + 1))
-
-        # FIXME: vgroup words by description and add synonym relationships!
-        for word in data['Word'].keys()[:]:
-            if '-' in word:
-                alt = word.replace('-', '')
-                if alt not in data['Word']:
-                    data['Word'][alt] = data['Word'][word]
+                                ord=i + 1)
 
         for i, (w, d, target) in enumerate(rel):
             for t in words_by_lemma.get(target, []):
-                DBSession.add(models.SeeAlso(
-                    source_pk=w.pk, target_pk=t.pk, description=d, ord=i))
+                writer.add(
+                    models.SeeAlso, source_pk=w.pk, target_pk=t.pk, description=d, ord=i)
 
         if skipped:
             print('{0} entries with no meaning skipped'.format(len(skipped)))
+        report_matches(matches)
@@ -1,30 +1,37 @@
 # coding: utf8
 from __future__ import unicode_literals
 import re
+import hashlib
+from collections import OrderedDict
 
 from clldutils.path import Path, md5
 from clldutils.jsonlib import load
-from clld.db.meta import DBSession
 from clld.db.models import common
 from clld.lib import bibtex
-from clld.scripts.util import bibtex2source
+from clld.scripts.util import bibtex2source, Data
 
 from dictionaria.lib import sfm
 from dictionaria.lib import cldf
-from dictionaria.lib.ingest import Examples
+from dictionaria.lib.ingest import Example
+from dictionaria.lib.media import get_catalogue, Files
+from dictionaria.lib.bulk import RecordingWriter, Row, values
 from dictionaria import models
 import dictionaria
 
 
 REPOS = Path(dictionaria.__file__).parent.joinpath('..', '..', 'dictionaria-intern')
+CDSTAR = REPOS.joinpath('cdstar.json')
+ABBREVIATION = re.compile('\$(?P<abbr>[a-z1-3][a-z]*(\.[a-z]+)?)')
+
+
+def abbreviation(m):
+    return m.group('abbr').upper()
 
 
 class Submission(object):
     def __init__(self, path):
         self.dir = path
         self.id = path.name
-
-        self.cdstar = load(REPOS.joinpath('cdstar.json'))
         print(self.dir)
         assert self.dir.exists()
         desc = self.dir.joinpath('md.html')
@@ -39,6 +46,34 @@ class Submission(object):
         bib = self.dir.joinpath('sources.bib')
         self.bib = bibtex.Database.from_file(bib) if bib.exists() else None
 
+    @property
+    def cdstar(self):
+        """
+        :return: The `Catalogue` of media files - shared by all submissions.
+        """
+        return get_catalogue(CDSTAR)
+
+    @property
+    def fingerprint(self):
+        """
+        :return: md5 checksum over the files the dictionary is loaded from.
+        """
+        processed = self.dir.joinpath('processed')
+        paths = [
+            self.dir.joinpath('md.json'),
+            self.dir.joinpath('md.html'),
+            self.dir.joinpath('sources.bib'),
+            processed.joinpath('examples.sfm'),
+        ]
+        if processed.joinpath('db.sfm').exists():
+            paths.append(processed.joinpath('db.sfm'))
+        else:
+            paths.append(self.dir.joinpath('cldf-md.json'))
+            paths.extend(sorted(self.dir.glob('*.csv')))
+        return hashlib.md5(''.join(
+            '{0}:{1}\n'.format(p.name, md5(p)) for p in paths if p.exists()
+        ).encode('utf8')).hexdigest()
+
     @property
     def dictionary(self):
         d = self.dir.joinpath('processed')
@@ -46,52 +81,97 @@ class Submission(object):
         return impl(d)
 
     def add_file(self, type_, checksum, file_cls, obj):
-        if checksum in self.cdstar:
-            jsondata = {k: v for k, v in self.props.get(type_, {}).items()}
-            jsondata.update(self.cdstar[checksum])
-            f = file_cls(
-                id='%s-%s' % (obj.id, checksum),
-                name=self.cdstar[checksum]['original'],
-                object_pk=obj.pk,
-                mime_type=self.cdstar[checksum]['mimetype'],
-                jsondata=jsondata)
-            DBSession.add(f)
-            DBSession.flush()
-            DBSession.refresh(f)
-            return
-        print('{0} file missing: {1}'.format(type_, checksum))
-        return
-
-    def load_sources(self, dictionary, data):
+        """
+        Register a media file for `obj` - to be written at the end of `load`.
+        """
+        self.files.add(type_, checksum, file_cls, obj)
+
+    def load_sources(self, dictionary, data, writer):
         if self.bib:
             for rec in self.bib.records:
                 src = bibtex2source(rec, models.DictionarySource)
-                src.dictionary = dictionary
                 src.id = '%s-%s' % (self.id, src.id)
-                data.add(models.DictionarySource, rec.id, _obj=bibtex2source(rec))
+                writer.add(
+                    models.DictionarySource, dictionary_pk=dictionary.pk, **values(src))
+                data['DictionarySource'][rec.id] = writer.add(
+                    common.Source, **values(bibtex2source(rec)))
 
-    def load_examples(self, dictionary, data, lang):
-        abbr_p = re.compile('\$(?P<abbr>[a-z1-3][a-z]*(\.[a-z]+)?)')
-        for i, ex in enumerate(
-                Examples.from_file(self.dir.joinpath('processed', 'examples.sfm'))):
-            obj = data.add(
+    def load_examples(self, dictionary, data, lang, writer):
+        """
+        Load the examples from `examples.sfm` - streaming the file and adding rows in
+        batches.
+        """
+        metalanguages = self.props.get('metalanguages', {})
+        gxx, gxy = metalanguages.get('gxx'), metalanguages.get('gxy')
+        normalize = Example.normalize
+
+        for i, ex in enumerate(sfm.iter_entries(
+                self.dir.joinpath('processed', 'examples.sfm'),
+                entry_impl=Example,
+                entry_sep='\n\n',
+                entry_prefix=None)):
+            writer.checkpoint()
+            id_ = ex.id
+            fields = {}
+            for k, v in ex:
+                fields.setdefault(k, v)
+            gloss = normalize(fields.get('gl'))
+            obj = data['Example'][id_] = writer.add(
                 models.Example,
-                ex.id,
-                id='%s-%s' % (self.id, ex.id.replace('.', '_')),
-                name=ex.text,
+                id='%s-%s' % (self.id, id_.replace('.', '_')),
+                name=fields.get('tx'),
                 number='{0}'.format(i + 1),
-                source=ex.corpus_ref,
-                language=lang,
+                source=fields.get('rf'),
+                language_pk=lang.pk,
                 serialized='{0}'.format(ex),
-                dictionary=dictionary,
-                analyzed=ex.morphemes,
-                gloss=abbr_p.sub(lambda m: m.group('abbr').upper(), ex.gloss) if ex.gloss else ex.gloss,
-                description=ex.translation,
-                alt_translation1=ex.alt_translation,
-                alt_translation_language1=self.props.get('metalanguages', {}).get('gxx'),
-                alt_translation2=ex.alt_translation2,
-                alt_translation_language2=self.props.get('metalanguages', {}).get('gxy'))
-            DBSession.flush()
-
-            if ex.soundfile:
-                self.add_file('audio', ex.soundfile, common.Sentence_files, obj)
+                dictionary_pk=dictionary.pk,
+                analyzed=normalize(fields.get('mb')),
+                gloss=ABBREVIATION.sub(abbreviation, gloss) if gloss else gloss,
+                description=fields.get('ft'),
+                alt_translation1=fields.get('ot'),
+                alt_translation_language1=gxx,
+                alt_translation2=fields.get('ota'),
+                alt_translation_language2=gxy)
+
+            if fields.get('sf'):
+                self.add_file('audio', fields['sf'], common.Sentence_files, obj)
+
+    def load(self, dictionary, lang, comparison_meanings, writer):
+        """
+        Load sources, examples and dictionary of the submission.
+
+        :param dictionary: The `Dictionary` - or a `Row` with its `pk` and `id`.
+        :param lang: The `Variety` - or a `Row` with its `pk` and `id`.
+        """
+        data = Data()
+        self.files = Files(self.cdstar, self.props)
+        self.load_sources(dictionary, data, writer)
+        self.load_examples(dictionary, data, lang, writer)
+        self.dictionary.load(
+            self,
+            data,
+            dictionary,
+            lang,
+            comparison_meanings,
+            OrderedDict(self.props.get('labels', [])),
+            writer)
+        self.files.flush(writer)
+        self.files.report()
+
+
+def prepare(spec):
+    """
+    Parse a submission and record its rows without database access.
+
+    This is run in worker processes of `initializedb --jobs N`.
+
+    :param spec: `(path, dictionary, language, comparison_meanings)` tuple, where \
+    dictionary and language are `dict`s with `pk` and `id`.
+    :return: `(submission ID, batches)` pair, where `batches` is suitable for \
+    `BulkWriter.extend`.
+    """
+    path, dictionary, lang, comparison_meanings = spec
+    submission = Submission(path)
+    writer = RecordingWriter()
+    submission.load(Row(dictionary), Row(lang), comparison_meanings, writer)
+    return submission.id, writer.batches()
@@ -7,13 +7,14 @@ from sqlalchemy import (
     Unicode,
     Integer,
     ForeignKey,
+    Index,
     Date,
     Boolean,
     func,
 )
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, joinedload, subqueryload
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.dialects.postgresql import TSVECTOR, JSONB
 
 from clld import interfaces
 from clld.db.meta import Base, CustomModelMixin
@@ -48,6 +49,17 @@ class Dictionary(CustomModelMixin, common.Contribution):
         style = "label label-{0}".format(style) if style else lang
         return HTML.span(lang, class_=style)
 
+    def custom_field_keys(self, fields='custom_fields'):
+        """
+        :param fields: Name of the list of custom fields - `custom_fields` or `second_tab`.
+        :return: `list` of the keys of the custom fields in the word data - fields for \
+        metalanguages are stored with prefix "lang-".
+        """
+        metalanguages = self.jsondata.get('metalanguages', {}).values()
+        return [
+            'lang-{0}'.format(name) if name in metalanguages else name
+            for name in self.jsondata.get(fields, [])]
+
 
 @implementer(interfaces.IParameter)
 class ComparisonMeaning(CustomModelMixin, common.Parameter):
@@ -81,6 +93,32 @@ class Word(CustomModelMixin, common.Unit):
     number = Column(Integer, default=0)  # for disambiguation of words with the same name
     example_count = Column(Integer, default=0)
 
+    @staticmethod
+    def refine_factory_query(query):
+        """
+        Load all objects rendered on the page of a word with a fixed number of queries.
+        """
+        meanings = subqueryload(Word.meanings)
+        # Sentences are loaded with the columns of the Example subclass:
+        sentences = meanings.subqueryload(Meaning.sentence_assocs)\
+            .joinedload(MeaningSentence.sentence.of_type(Example))
+        return query.options(
+            joinedload(Word.dictionary).subqueryload(Dictionary.contributor_assocs),
+            meanings.subqueryload(Meaning._files),
+            sentences.subqueryload(Example._files),
+            sentences.subqueryload(Example.references)
+            .joinedload(common.SentenceReference.source),
+            subqueryload(Word.counterparts)
+            .joinedload(Counterpart.valueset)
+            .joinedload(common.ValueSet.parameter),
+            subqueryload(Word.unitvalues).joinedload(common.UnitValue.unitparameter),
+            subqueryload(Word.references).joinedload(WordReference.source),
+            subqueryload(Word._files),
+            subqueryload(Word.data),
+            subqueryload(Word.target_assocs).joinedload(SeeAlso.target),
+            subqueryload(Word.source_assocs).joinedload(SeeAlso.source),
+        )
+
     def iterfiles(self):
         for file in self._files:
             yield file
@@ -122,6 +160,33 @@ class Word(CustomModelMixin, common.Unit):
         return split(self.semantic_domain)
 
 
+class WordListing(Base):
+    """Denormalized data of a word, as listed in the words table of a dictionary.
+
+    The listing has one row per word - so the table can be filtered, sorted and paged
+    without joins - and is refreshed in `prime_cache`.
+    """
+    __table_args__ = (
+        # Words of a dictionary in alphabetical order - for keyset pagination:
+        Index(
+            'ix_wordlisting_dictionary_pk_name', 'dictionary_pk', 'name', 'number', 'pk'),
+    )
+    pk = Column(Integer, ForeignKey('word.pk'), primary_key=True)
+    word = relationship(Word, backref=backref('listing', uselist=False))
+    dictionary_pk = Column(Integer, ForeignKey('dictionary.pk'))
+    name = Column(Unicode)
+    number = Column(Integer)
+    pos = Column(Unicode)
+    description = Column(Unicode)
+    example_count = Column(Integer)
+    semantic_domain = Column(Unicode)
+    comparison_meanings = Column(Unicode)
+    # The values of the Unit_data of the word, keyed by key:
+    data = Column(JSONB)
+    # URL of the thumbnail of the first image of the word:
+    thumbnail = Column(Unicode)
+
+
 class WordReference(Base, common.HasSourceMixin):
     word_pk = Column(Integer, ForeignKey('word.pk'))
     word = relationship(Word, backref="references")
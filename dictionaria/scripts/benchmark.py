@@ -0,0 +1,502 @@
+# coding: utf8
+"""
+Micro-benchmarks for performance critical code.
+
+Usage:
+    python dictionaria/scripts/benchmark.py [--db DB] [BENCHMARK ...]
+
+Benchmarks marked with "(db)" run queries against the database specified as
+SQLAlchemy URL with --db.
+"""
+from __future__ import unicode_literals, print_function, division
+import argparse
+import random
+import re
+import time
+from collections import OrderedDict, defaultdict
+from copy import copy
+
+from sqlalchemy import create_engine, func, or_
+from clld.db.meta import DBSession
+from clld.db.models import common
+from clld.db.util import icontains
+
+from clldutils.jsonlib import load
+from clldutils import sfm as _sfm
+
+from dictionaria.util import Link, Linker
+from dictionaria import search
+from dictionaria.lib import concepts
+from dictionaria.lib import sfm
+from dictionaria.lib.ingest import split
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(f):
+    BENCHMARKS[f.__name__] = f
+    return f
+
+
+def timed(label, f, *args, **kw):
+    start = time.time()
+    res = f(*args, **kw)
+    print('{0:<30} {1:>8.3f}s'.format(label, time.time() - start))
+    return res
+
+
+def percentiles(label, durations):
+    durations = sorted(durations)
+
+    def p(n):
+        return durations[min(int(len(durations) * n / 100), len(durations) - 1)] * 1000
+
+    print('{0:<40} p50 {1:>8.1f}ms  p95 {2:>8.1f}ms  max {3:>8.1f}ms'.format(
+        label, p(50), p(95), durations[-1] * 1000))
+
+
+def regex_links(sid, ids, desc, type_):
+    # The former, regex-based implementation of `util.Linker`:
+    p = re.compile(
+        '((?<=\W)|^)(?P<id>{0})(?=\W|$)'.format('|'.join(re.escape(id_) for id_ in ids)),
+        flags=re.MULTILINE)
+    return p.sub(lambda m: '{0}'.format(Link(sid + '-' + m.group('id'), type_)), desc)
+
+
+@benchmark
+def links(args):
+    """
+    Linking word IDs in a text, with a synthetic dictionary of 50,000 words.
+    """
+    rnd = random.Random(1)
+    ids = ['{0}-{1}'.format(i, j) for i in range(1, 25001) for j in (1, 2)]
+    tokens = []
+    for _ in range(20000):
+        r = rnd.random()
+        if r < 0.2:
+            tokens.append(rnd.choice(ids))
+        elif r < 0.3:
+            tokens.append('x{0}'.format(rnd.randint(1, 99999)))
+        else:
+            tokens.append(rnd.choice(['the', 'see', 'cf.', '(1)', '\n']))
+    text = ' '.join(tokens)
+    print('{0} IDs, text of {1} characters'.format(len(ids), len(text)))
+
+    res1 = timed('regex alternation', regex_links, 'd', ids, text, 'unit')
+    linker = timed('Linker: build', Linker, 'd', ids, 'unit')
+    res2 = timed('Linker: match', linker, text)
+    assert res1 == res2
+
+
+@benchmark
+def concept_lookup(args):
+    """
+    Looking up Concepticon labels in the memory-mapped index, compared to the parsed JSON.
+    """
+    try:
+        import tracemalloc
+    except ImportError:  # pragma: no cover
+        tracemalloc = None
+
+    def load_json():
+        return load(concepts.JSON)
+
+    def load_index():
+        concepts._index = None
+        return concepts.get_index()
+
+    def lookup_json(labels, s):
+        if s in labels['conceptset_labels']:
+            return labels['conceptset_labels'][s]
+        return labels['alternative_labels'].get(s)
+
+    rnd = random.Random(1)
+    labels = load_json()
+    keys = list(labels['conceptset_labels']) + list(labels['alternative_labels'])
+    queries = [rnd.choice(keys) if rnd.random() < 0.5 else 'no {0}'.format(rnd.choice(keys))
+               for _ in range(100000)]
+
+    for label, loader, lookup in [
+        ('JSON dict', load_json, lookup_json),
+        ('mmap index', load_index, lambda index, s: index.get(s)),
+    ]:
+        if tracemalloc:
+            tracemalloc.start()
+        obj = timed('{0}: load'.format(label), loader)
+        if tracemalloc:
+            print('{0:<30} {1:>8.1f}KB'.format(
+                '{0}: memory'.format(label), tracemalloc.get_traced_memory()[0] / 1024))
+            tracemalloc.stop()
+        start = time.time()
+        for s in queries:
+            lookup(obj, s)
+        print('{0:<30} {1:>8.0f}/s'.format(
+            '{0}: lookups'.format(label), len(queries) / (time.time() - start)))
+
+
+@benchmark
+def concept_matching(args):
+    """
+    Matching glosses to Concepticon concept sets, with and without the memo cache.
+    """
+    rnd = random.Random(1)
+    labels = load(concepts.JSON)
+    keys = list(labels['conceptset_labels']) + list(labels['alternative_labels'])
+    variants = [
+        lambda k: k,
+        lambda k: 'to {0} (sth.)'.format(k),
+        lambda k: '{0}s'.format(k),
+        lambda k: 'The {0}.'.format(k.capitalize()),
+        lambda k: 'no {0}'.format(k),
+    ]
+    glosses = [rnd.choice(variants)(rnd.choice(keys)) for _ in range(100000)]
+
+    concepts._index = concepts._matcher = None
+    matcher = timed('Matcher: load', concepts.get_matcher)
+    for label, cache_size in [('uncached', 0), ('cached', 100000)]:
+        matcher._cache, matcher.cache_size = {}, cache_size
+        start = time.time()
+        for s in glosses:
+            matcher.match(s)
+        print('{0:<30} {1:>8.0f}/s'.format(
+            'Matcher: {0}'.format(label), len(glosses) / (time.time() - start)))
+
+
+class LegacyMeaning(object):
+    # The former implementation of `sfm.Meaning`, `sfm.Word` and `sfm.Entry.get_words`:
+    def __init__(self):
+        self.de = None
+        self.ge = None
+        self.gxx = None
+        self.gxy = None
+        self.re = None
+        self.sd = []
+        self.xref = []
+
+
+class LegacyWord(object):
+    def __init__(self, form):
+        self.form = form
+        self._hm = 0
+        self.ph = None
+        self._ps = None
+        self.data = defaultdict(list)
+        self.rel = []
+        self.meanings = []
+
+    @property
+    def ps(self):
+        return self._ps
+
+    @ps.setter
+    def ps(self, value):
+        if self._ps and self._ps != value:
+            raise ValueError()
+        self._ps = value
+
+    @property
+    def hm(self):
+        return '{0}'.format(self._hm) if self._hm else ''
+
+    @hm.setter
+    def hm(self, value):
+        m = re.search('(?P<number>[0-9]+)', value)
+        self._hm = int(m.group('number')) if m else 0
+
+    def copy(self):
+        w = LegacyWord(self.form)
+        w.ph = self.ph
+        if not self.hm:
+            self.hm = '1'
+        w.hm = '{0}'.format(int(self.hm) + 1)
+        w.data = copy(self.data)
+        return w
+
+
+class LegacyEntry(sfm.Entry):
+    def get_words(self):
+        word, pos, meaning, first_meaning, sn_is_se = None, None, None, True, False
+        for k, v in self:
+            if k in ['lx', 'se']:
+                if word:
+                    yield self.checked_word(word, meaning, pos)
+                word = LegacyWord(v)
+                meaning = LegacyMeaning()
+            elif k == 'sn':
+                word.hm = word.hm or v
+                if first_meaning:
+                    sn_is_se = not bool(pos)
+                    first_meaning = False
+                else:
+                    self.checked_word(word, meaning, pos)
+                    if sn_is_se and word.form:
+                        yield word
+                        word = word.copy()
+                    meaning = LegacyMeaning()
+            elif k in ['de', 'ge', 're', 'gxx', 'gxy']:
+                setattr(meaning, k, v)
+            elif k == 'sd':
+                meaning.sd.append(v)
+            elif k == 'xref':
+                meaning.xref.append(v)
+            elif k in ['hm', 'ph']:
+                if getattr(word, k) is None:
+                    setattr(word, k, v)
+            elif k == 'ps':
+                pos = v
+                try:
+                    word.ps = v
+                except ValueError:
+                    self.checked_word(word, meaning, pos)
+                    if word.form:
+                        yield word
+                        word = word.copy()
+                        word.ps = v
+                    meaning = LegacyMeaning()
+            elif k in sfm.RELATION_MAP:
+                word.rel.extend(
+                    [(sfm.RELATION_MAP[k], vv.strip()) for vv in split(v, ',')])
+            else:
+                word.data[k].append(v)
+        if word and word.form:
+            yield self.checked_word(word, meaning, pos)
+
+
+# Entries shaped like the ones in real submissions:
+SFM_ENTRIES = [
+    r"""\lx {0}
+\ps n
+\sd fauna
+\sd fish
+\dn blak krab
+\de shore crab
+\ge shore.crab
+\dt 29/Mar/2010""",
+    r"""\lx {0}
+\hm 2
+\ps conj
+\sn 1
+\dn be
+\ge but
+\sn 2
+\dn mo
+\de and
+\ge and
+\dt 13/Nov/2009""",
+    r"""\lx {0}
+\ps n
+\sd plants
+\de nettle
+\ge nettle
+\se {0} ne tes
+\de jellyfish (lit. "nettle of the sea")
+\cf {0}, {0} ne tes
+\se l{0}
+\de nettle tree
+\dt 29/Mar/2010""",
+    r"""\lx {0}
+\sf {0}.wav
+\pl {0}te
+\sn 1
+\ps n
+\ge fool
+\xv Het durħu {0}de.
+\xe That boy was a fool.
+\sn 2
+\ps adj
+\ge stupid; foolish
+\dt 08/Sep/2011""",
+    r"""\lx {0}
+\ph [{0}]
+\ps v.intr
+\sn 1
+\ge come_down
+\de come down to the bottom
+\xref 47d85a28df71ac0647ca29dc6a6807e3
+\sn 2
+\ge exit
+\sy {0}me
+\se -{0}
+\ps v.tr.gen
+\de release, unleash, let out
+\gxx mengeluarkan
+\dt 05/Aug/2011""",
+]
+
+
+def sfm_corpus(n, seed=1):
+    """
+    :return: `list` of SFM entry texts - half of them real-shaped, half of them \
+    synthetic, with random sub-entries, senses - numbered before or after \\ps - and \
+    multiple \\ps.
+    """
+    rnd = random.Random(seed)
+
+    def form():
+        return ''.join(rnd.choice('aeiouptkmnslrwy') for _ in range(rnd.randint(2, 9)))
+
+    res = []
+    for i in range(n):
+        if i % 2:
+            res.append(rnd.choice(SFM_ENTRIES).format(form()))
+            continue
+        lines = ['\\lx {0}'.format(form())]
+        for j in range(rnd.choice([1, 1, 1, 2, 3])):
+            if j:
+                lines.append('\\se {0}'.format(form()))
+            sn_first = rnd.random() < 0.3
+            if not sn_first:
+                lines.append('\\ps {0}'.format(rnd.choice(['n', 'v', 'adj', 'adv'])))
+            for k in range(rnd.choice([0, 1, 1, 2, 3])):
+                lines.append('\\sn {0}'.format(k + 1))
+                if sn_first or rnd.random() < 0.1:
+                    lines.append('\\ps {0}'.format(rnd.choice(['n', 'v', 'adj'])))
+                lines.append('\\ge {0}'.format(form()))
+                if rnd.random() < 0.7:
+                    lines.append('\\de {0} {1}'.format(form(), form()))
+                if rnd.random() < 0.3:
+                    lines.append('\\sd {0}'.format(rnd.choice(['fauna', 'flora', 'body'])))
+                if rnd.random() < 0.3:
+                    lines.append('\\xref {0}'.format(rnd.randint(1, 1000)))
+            if not rnd.randint(0, 2):
+                lines.append('\\ge {0}'.format(form()))
+            for marker in ['ph', 'cf', 'nt', 'sf', 'pl', 'et']:
+                if rnd.random() < 0.2:
+                    lines.append('\\{0} {1}'.format(marker, form()))
+        lines.append('\\dt 05/Aug/2011')
+        res.append('\n'.join(lines))
+    return res
+
+
+def dump_words(words):
+    return [(
+        w.form, w.hm, w.ph, w.ps, sorted(w.data.items()), w.rel,
+        [(m.de, m.ge, m.gxx, m.gxy, m.re, m.sd, m.xref) for m in w.meanings])
+        for w in words]
+
+
+@benchmark
+def sfm_words(args):
+    """
+    Splitting SFM entries into words, compared to the former implementation.
+    """
+    texts = sfm_corpus(20000)
+    entries = OrderedDict()
+    for label, cls in [('if/elif chain', LegacyEntry), ('dispatch table', sfm.Entry)]:
+        entries[label] = [
+            cls([(k, v.strip()) for k, v in _sfm.marker_split(text) if v.strip()])
+            for text in texts]
+
+    results = OrderedDict()
+    for label, es in entries.items():
+        best = None
+        for _ in range(3):
+            start = time.time()
+            results[label] = [list(e.get_words()) for e in es]
+            duration = time.time() - start
+            best = duration if best is None else min(best, duration)
+        print('{0:<30} {1:>8.0f} entries/s'.format(label, len(es) / best))
+
+    legacy, new = [[dump_words(words) for words in res] for res in results.values()]
+    assert legacy == new
+    print('{0:<30} {1:>8} words'.format('identical output', sum(len(w) for w in new)))
+
+
+@benchmark
+def headword_search(args):
+    """
+    (db) Searching headwords for substrings and prefixes of random words of the corpus.
+    """
+    rnd = random.Random(1)
+    names = [n for n, in DBSession.query(common.Unit.name)
+             .order_by(func.random()).limit(1000) if n and len(n) > 3]
+    queries = OrderedDict()
+    queries['substring'] = []
+    queries['prefix'] = []
+    for name in names[:200]:
+        i = rnd.randint(0, len(name) - 3)
+        queries['substring'].append(name[i:i + 3])
+        queries['prefix'].append('^' + name[:3])
+
+    conditions = OrderedDict()
+    conditions['icontains OR unaccent'] = lambda qs: or_(
+        icontains(common.Unit.name, qs),
+        func.unaccent(common.Unit.name).contains(func.unaccent(qs)))
+    conditions['unaccent_lower trigram'] = lambda qs: search.search(common.Unit.name, qs)
+
+    for mode, qss in queries.items():
+        for label, condition in conditions.items():
+            durations = []
+            for qs in qss:
+                start = time.time()
+                DBSession.query(common.Unit.pk).filter(condition(qs))\
+                    .order_by(common.Unit.name).limit(50).all()
+                durations.append(time.time() - start)
+            percentiles('{0}: {1}'.format(mode, label), durations)
+
+
+@benchmark
+def fulltext_index(args):
+    """
+    (db) Size and ranked search of the weighted full-text index, compared to an index of
+    flat vectors of the serialized entries.
+    """
+    DBSession.execute("""
+    CREATE TEMP TABLE flat_fts AS
+      SELECT pk, to_tsvector('english', coalesce(serialized, '')) AS fts FROM word""")
+    DBSession.execute("CREATE INDEX flat_fts_index ON flat_fts USING gin (fts)")
+    DBSession.execute("ANALYZE flat_fts")
+    # Queries for random single-word headwords - which should be ranked high:
+    terms = [n for n, in DBSession.execute("""
+    SELECT u.name FROM unit AS u, word AS w
+    WHERE u.pk = w.pk AND u.name ~ '^[a-z]{4,}$'
+    ORDER BY random() LIMIT 200""")]
+
+    for label, table, index in [
+        ('flat', 'flat_fts', 'flat_fts_index'),
+        ('weighted', 'word', 'fts_index'),
+    ]:
+        vectors, index_size = DBSession.execute(
+            "SELECT sum(pg_column_size(fts)), pg_relation_size('{1}') FROM {0}".format(
+                table, index)).fetchone()
+        print('{0:<40} vectors {1:>8.1f}MB  index {2:>8.1f}MB'.format(
+            label, (vectors or 0) / 1024 / 1024, index_size / 1024 / 1024))
+
+        durations, reciprocal_ranks = [], []
+        for term in terms:
+            start = time.time()
+            pks = [r[0] for r in DBSession.execute("""
+            SELECT t.pk FROM {0} AS t
+            WHERE t.fts @@ plainto_tsquery('english', :q)
+            ORDER BY ts_rank_cd(t.fts, plainto_tsquery('english', :q)) DESC, t.pk
+            LIMIT 20""".format(table), dict(q=term))]
+            durations.append(time.time() - start)
+            headwords = set(r[0] for r in DBSession.execute(
+                "SELECT pk FROM unit WHERE name = :q", dict(q=term)))
+            ranks = [i + 1 for i, pk in enumerate(pks) if pk in headwords]
+            reciprocal_ranks.append(1 / ranks[0] if ranks else 0)
+        percentiles('{0}: ranked search'.format(label), durations)
+        print('{0:<40} MRR of headword matches {1:.3f}'.format(
+            label, sum(reciprocal_ranks) / len(reciprocal_ranks)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0].strip())
+    parser.add_argument(
+        '--db', help="SQLAlchemy URL of the database", default=None)
+    parser.add_argument(
+        'benchmark', nargs='*', choices=list(BENCHMARKS), metavar='BENCHMARK',
+        help=', '.join(BENCHMARKS))
+    args = parser.parse_args()
+    if args.db:
+        DBSession.configure(bind=create_engine(args.db))
+    for name in args.benchmark or BENCHMARKS:
+        if BENCHMARKS[name].__doc__.strip().startswith('(db)') and not args.db:
+            continue
+        print('{0}: {1}'.format(name, BENCHMARKS[name].__doc__.strip()))
+        BENCHMARKS[name](args)
+        print('')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,43 @@
 from __future__ import unicode_literals
 from datetime import date
-from itertools import groupby, chain
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict
 import re
+import multiprocessing
 
 import transaction
 from nameparser import HumanName
-from sqlalchemy.orm import joinedload_all, joinedload
-from clldutils.misc import slug, nfilter, UnicodeMixin
+from clldutils.misc import slug, UnicodeMixin
 from clld.util import LGR_ABBRS
 from clld.scripts.util import Data, initializedb
 from clld.db.meta import DBSession
 from clld.db.models import common
 from clld.db import fts
 from clld_glottologfamily_plugin.util import load_families
+from clldmpg.cdstar import bitstream_url
 from pyconcepticon.api import Concepticon
 
 import dictionaria
-from dictionaria.models import ComparisonMeaning, Dictionary, Word, Variety, Meaning_files, Meaning
-from dictionaria.lib.submission import REPOS, Submission
-from dictionaria.util import join, Link
-
+from dictionaria import search
+from dictionaria.models import (
+    ComparisonMeaning, Dictionary, Word, Variety, Meaning, Meaning_files,
+)
+from dictionaria.lib.submission import REPOS, CDSTAR, Submission, prepare
+from dictionaria.lib.media import get_catalogue
+from dictionaria.lib.bulk import get_writer, BulkWriter
+from dictionaria.lib import export, cache
+from dictionaria.util import Link
+
+
+def create(args, data):
+    """
+    Create the dataset and the comparison meanings.
 
-def main(args):
+    :return: `dict` mapping Concepticon conceptset IDs to ComparisonMeaning pks.
+    """
     fts.index('fts_index', Word.fts, DBSession.bind)
+    search.index('unit_name_trgm_index', common.Unit.name, DBSession.bind)
     DBSession.execute("CREATE EXTENSION IF NOT EXISTS unaccent WITH SCHEMA public;")
 
-    data = Data()
-
     dataset = common.Dataset(
         id=dictionaria.__name__,
         name="Dictionaria",
@@ -80,7 +90,58 @@ def main(args):
 
     print('... done')
 
-    comparison_meanings = {k: v.pk for k, v in comparison_meanings.items()}
+    return {k: v.pk for k, v in comparison_meanings.items()}
+
+
+def delete_dictionary(pk):
+    """
+    Delete a dictionary and all data loaded from its submission.
+    """
+    words = "SELECT pk FROM word WHERE dictionary_pk = :pk"
+    meanings = "SELECT pk FROM meaning WHERE word_pk IN ({0})".format(words)
+    examples = "SELECT pk FROM example WHERE dictionary_pk = :pk"
+    for sql in [
+        "DELETE FROM wordlisting WHERE dictionary_pk = :pk",
+        "DELETE FROM unit_data WHERE object_pk IN ({0})".format(words),
+        "DELETE FROM unit_files WHERE object_pk IN ({0})".format(words),
+        "DELETE FROM meaning_files WHERE object_pk IN ({0})".format(meanings),
+        "DELETE FROM meaningsentence WHERE meaning_pk IN ({0})".format(meanings),
+        "DELETE FROM meaning WHERE word_pk IN ({0})".format(words),
+        "DELETE FROM seealso WHERE source_pk IN ({0}) OR target_pk IN ({0})".format(words),
+        "DELETE FROM wordreference WHERE word_pk IN ({0})".format(words),
+        "DELETE FROM counterpart WHERE word_pk IN ({0})".format(words),
+        "DELETE FROM value WHERE valueset_pk IN "
+        "(SELECT pk FROM valueset WHERE contribution_pk = :pk)",
+        "DELETE FROM valueset WHERE contribution_pk = :pk",
+        "WITH w AS (DELETE FROM word WHERE dictionary_pk = :pk RETURNING pk) "
+        "DELETE FROM unit WHERE pk IN (SELECT pk FROM w)",
+        "DELETE FROM sentence_files WHERE object_pk IN ({0})".format(examples),
+        "WITH e AS (DELETE FROM example WHERE dictionary_pk = :pk RETURNING pk) "
+        "DELETE FROM sentence WHERE pk IN (SELECT pk FROM e)",
+        # Sources are loaded twice: As DictionarySource with ID "<dictionary>-<key>" and
+        # as plain Source with ID "<key>", which is the one referenced by WordReference.
+        "DELETE FROM source WHERE polymorphic_type = 'base' AND id IN ("
+        "SELECT substr(s.id, char_length(c.id) + 2) "
+        "FROM source AS s, dictionarysource AS ds, contribution AS c "
+        "WHERE s.pk = ds.pk AND ds.dictionary_pk = c.pk AND c.pk = :pk)",
+        "WITH s AS (DELETE FROM dictionarysource WHERE dictionary_pk = :pk RETURNING pk) "
+        "DELETE FROM source WHERE pk IN (SELECT pk FROM s)",
+        "DELETE FROM contributioncontributor WHERE contribution_pk = :pk",
+        "DELETE FROM dictionary WHERE pk = :pk",
+        "DELETE FROM contribution WHERE pk = :pk",
+    ]:
+        DBSession.execute(sql, dict(pk=pk))
+
+
+def main(args):
+    data = Data()
+    new_varieties = set()
+    if args.incremental:
+        comparison_meanings = {
+            cid: pk for cid, pk in DBSession.query(ComparisonMeaning.id, ComparisonMeaning.pk)}
+        args.reloaded = []
+    else:
+        comparison_meanings = create(args, data)
     submissions = []
 
     for submission in REPOS.joinpath(
@@ -103,8 +164,21 @@ def main(args):
         id_ = submission.id
         if args.dict and args.dict != id_ and args.dict != 'all':
             continue
+
+        fingerprint = submission.fingerprint
+        if args.incremental:
+            old = DBSession.query(Dictionary.pk, Dictionary.jsondata)\
+                .filter(Dictionary.id == id_).first()
+            if old:
+                if old.jsondata.get('fingerprint') == fingerprint:
+                    continue
+                print('deleting %s ...' % id_)
+                delete_dictionary(old.pk)
+            args.reloaded.append(id_)
+
         lmd = md['language']
         props = md.get('properties', {})
+        props['fingerprint'] = fingerprint
         props.setdefault('custom_fields', [])
         props['metalanguage_styles'] = {}
         for v, s in zip(props.get('metalanguages', {}).values(),
@@ -114,9 +188,13 @@ def main(args):
                                   for f in props['custom_fields']]
 
         language = data['Variety'].get(lmd['glottocode'])
+        if not language and args.incremental:
+            language = data['Variety'][lmd['glottocode']] = Variety.get(
+                lmd['glottocode'], default=None)
         if not language:
             language = data.add(
                 Variety, lmd['glottocode'], id=lmd['glottocode'], name=lmd['name'])
+            new_varieties.add(language.id)
 
         md['date_published'] = md['date_published'] or date.today().isoformat()
         if '-' not in md['date_published']:
@@ -141,6 +219,9 @@ def main(args):
             name = HumanName(cname)
             cid = slug('%s%s' % (name.last, name.first))
             contrib = data['Contributor'].get(cid)
+            if not contrib and args.incremental:
+                contrib = data['Contributor'][cid] = common.Contributor.get(
+                    cid, default=None)
             if not contrib:
                 contrib = data.add(
                     common.Contributor,
@@ -159,29 +240,49 @@ def main(args):
         submissions.append((dictionary.id, language.id, submission))
     transaction.commit()
 
-    for did, lid, submission in submissions:
-        #if submission.id != 'sidaama':
-        #    continue
-        transaction.begin()
-        print('loading %s ...' % submission.id)
-        dictdata = Data()
-        lang = Variety.get(lid)
-        submission.load_sources(Dictionary.get(did), dictdata)
-        submission.load_examples(Dictionary.get(did), dictdata, lang)
-        submission.dictionary.load(
-            submission,
-            dictdata,
-            Dictionary.get(did),
-            lang,
-            comparison_meanings,
-            OrderedDict(submission.md.get('properties', {}).get('labels', [])))
-        transaction.commit()
-        print('... done')
+    if args.jobs > 1:
+        # Submissions are parsed in worker processes, while only this process writes
+        # to the database, committing one submission at a time. The media catalogue is
+        # loaded before, to be shared by the forked workers.
+        get_catalogue(CDSTAR)
+        pool = multiprocessing.Pool(args.jobs)
+        try:
+            specs = [
+                (submission.dir,
+                 dict(pk=Dictionary.get(did).pk, id=did),
+                 dict(pk=Variety.get(lid).pk, id=lid),
+                 comparison_meanings) for did, lid, submission in submissions]
+            for sid, batches in pool.imap_unordered(prepare, specs):
+                transaction.begin()
+                print('loading %s ...' % sid)
+                writer = BulkWriter()
+                writer.extend(batches)
+                writer.flush()
+                writer.report()
+                transaction.commit()
+                print('... done')
+            pool.close()
+            pool.join()
+        finally:
+            # Make sure, the workers are stopped if loading fails.
+            pool.terminate()
+    else:
+        for did, lid, submission in submissions:
+            transaction.begin()
+            print('loading %s ...' % submission.id)
+            writer = get_writer(args.bulk)
+            submission.load(
+                Dictionary.get(did), Variety.get(lid), comparison_meanings, writer)
+            writer.flush()
+            writer.report()
+            transaction.commit()
+            print('... done')
 
     transaction.begin()
     load_families(
         Data(),
-        [v for v in DBSession.query(Variety) if re.match('[a-z]{4}[0-9]{4}', v.id)],
+        [v for v in DBSession.query(Variety)
+         if v.id in new_varieties and re.match('[a-z]{4}[0-9]{4}', v.id)],
         glottolog_repos='../../glottolog3/glottolog')
 
 
@@ -189,94 +290,250 @@ def prime_cache(cfg):
     """If data needs to be denormalized for lookup, do that here.
     This procedure should be separate from the db initialization, because
     it will have to be run periodically whenever data has been updated.
+
+    After `initializedb --incremental` only the reloaded dictionaries are processed.
+
+    Denormalized data is computed with set-based SQL, thus runs in bounded memory.
     """
-    from dictionaria.util import add_links2
-
-    labels = {}
-    for type_, cls in [('source', common.Source), ('unit', common.Unit)]:
-        labels[type_] = defaultdict(set)
-        for r in DBSession.query(cls.id):
-            sid, _, lid = r[0].partition('-')
-            labels[type_][sid].add(lid)
-
-    for d in DBSession.query(Dictionary):
-        for type_ in ['source', 'unit']:
-            d.description = add_links2(d.id, labels[type_][d.id], d.description, type_)
-
-    for meaning in DBSession.query(ComparisonMeaning).options(
-        joinedload_all(common.Parameter.valuesets, common.ValueSet.values)
-    ):
-        meaning.representation = sum([len(vs.values) for vs in meaning.valuesets])
-        if meaning.representation == 0:
-            meaning.active = False
-
-    def joined(iterable):
-        return ' / '.join(sorted(nfilter(set(iterable))))
-
-    q = DBSession.query(Word)\
-        .order_by(Word.dictionary_pk, common.Unit.name, common.Unit.pk)\
-        .options(joinedload(Word.meanings), joinedload(Word.dictionary))
-    for _, words in groupby(q, lambda u: u.name):
-        words = list(words)
-        for i, word in enumerate(words):
-            word.description = ' / '.join(m.name for m in word.meanings)
-            word.comparison_meanings = joined(m.reverse for m in word.meanings)
-            word.semantic_domain = joined(m.semantic_domain for m in word.meanings)
-            word.number = i + 1 if len(words) > 1 else 0
-
-            for suffix in ['1', '2']:
-                alt_t, alt_l = [], []
-                for m in word.meanings:
-                    if getattr(m, 'alt_translation' + suffix):
-                        alt_l.append(getattr(m, 'alt_translation_language' + suffix))
-                        alt_t.append(getattr(m, 'alt_translation' + suffix))
-                if alt_t and len(set(alt_l)) == 1:
-                    DBSession.add(common.Unit_data(
-                        object_pk=word.pk, key='lang-' + alt_l.pop(), value=join(alt_t)))
-
-    def count_unit_media_files(contrib, mtype):
-        return DBSession.query(common.Unit_files)\
-            .join(Word, common.Unit_files.object_pk == Word.pk)\
-            .filter(Word.dictionary_pk == contrib.pk)\
-            .filter(common.Unit_files.mime_type.ilike(mtype + '/%'))\
-            .count() + \
-            DBSession.query(Meaning_files)\
-            .join(Meaning, Meaning_files.object_pk == Meaning.pk)\
-            .join(Word, Meaning.word_pk == Word.pk)\
-            .filter(Word.dictionary_pk == contrib.pk)\
-            .filter(Meaning_files.mime_type.ilike(mtype + '/%'))\
-            .count()
-
-    for d in DBSession.query(Dictionary).options(joinedload(Dictionary.words)):
-        d.count_words = len(d.words)
-        sds = set(chain(*[w.semantic_domain_list for w in d.words]))
-        d.semantic_domains = join(sorted(sds))
-        d.count_audio = count_unit_media_files(d, 'audio')
-        d.count_image = count_unit_media_files(d, 'image')
-
-        word_pks = [w.pk for w in d.words]
+    from dictionaria.util import link_index, prerendered_description
+
+    reloaded = getattr(cfg, 'reloaded', None)
+    if reloaded is not None and not reloaded:
+        return
+    dpks = [pk for pk, in DBSession.query(Dictionary.pk).filter(Dictionary.id.in_(reloaded))]\
+        if reloaded else None
+
+    def scoped(query, col):
+        return query.filter(col.in_(dpks)) if dpks is not None else query
+
+    def execute(sql):
+        # The placeholder {scope} is used to restrict statements to the dictionaries in
+        # scope, e.g. "WHERE w.dictionary_pk {scope}".
+        return DBSession.execute(
+            sql.format(scope='= ANY(:dpks)' if dpks is not None else 'IS NOT NULL'),
+            dict(dpks=dpks))
+
+    for d in scoped(DBSession.query(Dictionary), Dictionary.pk):
+        d.description = link_index(d).add_links(d.description)
+        html, toc = prerendered_description(d, cfg.env['request'])
+        d.update_jsondata(description_html=html, toc=toc)
+
+    DBSession.execute("""
+    UPDATE comparisonmeaning AS cm
+      SET representation = (
+        SELECT count(v.pk)
+        FROM valueset AS vs, value AS v
+        WHERE vs.parameter_pk = cm.pk AND v.valueset_pk = vs.pk
+      )
+    """)
+    DBSession.execute("""
+    UPDATE parameter AS p
+      SET active = cm.representation > 0
+      FROM comparisonmeaning AS cm
+      WHERE p.pk = cm.pk
+    """)
+
+    #
+    # Denormalize meaning data on words. Lists of distinct values are sorted with the
+    # "C" collation, i.e. by codepoint.
+    #
+    execute("""
+    UPDATE unit
+      SET description = s.description
+      FROM (
+        SELECT w.pk, coalesce(string_agg(m.name, ' / ' ORDER BY m.ord, m.pk), '') AS description
+        FROM word AS w LEFT OUTER JOIN meaning AS m ON m.word_pk = w.pk
+        WHERE w.dictionary_pk {scope}
+        GROUP BY w.pk
+      ) AS s
+      WHERE unit.pk = s.pk
+    """)
+    execute("""
+    UPDATE word
+      SET comparison_meanings = s.cm, semantic_domain = s.sd
+      FROM (
+        SELECT
+          w.pk,
+          coalesce(string_agg(
+            DISTINCT m.reverse COLLATE "C", ' / ' ORDER BY m.reverse COLLATE "C"
+          ) FILTER (WHERE m.reverse != ''), '') AS cm,
+          coalesce(string_agg(
+            DISTINCT m.semantic_domain COLLATE "C", ' / ' ORDER BY m.semantic_domain COLLATE "C"
+          ) FILTER (WHERE m.semantic_domain != ''), '') AS sd
+        FROM word AS w LEFT OUTER JOIN meaning AS m ON m.word_pk = w.pk
+        WHERE w.dictionary_pk {scope}
+        GROUP BY w.pk
+      ) AS s
+      WHERE word.pk = s.pk
+    """)
+    # Homonyms within a dictionary are numbered in order of creation:
+    execute("""
+    UPDATE word
+      SET number = s.number
+      FROM (
+        SELECT
+          w.pk,
+          CASE
+            WHEN count(*) OVER h > 1 THEN row_number() OVER (h ORDER BY w.pk)
+            ELSE 0
+          END AS number
+        FROM word AS w, unit AS u
+        WHERE w.pk = u.pk AND w.dictionary_pk {scope}
+        WINDOW h AS (PARTITION BY w.dictionary_pk, u.name)
+      ) AS s
+      WHERE word.pk = s.pk
+    """)
+    # Alternative translations of all meanings in the same language are collected as
+    # Unit_data:
+    for suffix in ['1', '2']:
+        execute("""
+        INSERT INTO unit_data
+          (object_pk, key, value, ord, jsondata, active, version, created, updated)
+          SELECT
+            m.word_pk,
+            'lang-' || min(m.alt_translation_language{0}),
+            string_agg(m.alt_translation{0}, ' ; ' ORDER BY m.ord, m.pk),
+            1, '{{{{}}}}', true, 1, now(), now()
+          FROM meaning AS m, word AS w
+          WHERE m.word_pk = w.pk AND w.dictionary_pk {{scope}} AND m.alt_translation{0} != ''
+          GROUP BY m.word_pk
+          HAVING
+            count(DISTINCT m.alt_translation_language{0}) = 1
+            AND bool_and(m.alt_translation_language{0} IS NOT NULL)
+        """.format(suffix))
+
+    #
+    # Denormalize word data on dictionaries.
+    #
+    execute("""
+    WITH media AS (
+      SELECT w.dictionary_pk, f.mime_type
+      FROM unit_files AS f, word AS w
+      WHERE f.object_pk = w.pk
+      UNION ALL
+      SELECT w.dictionary_pk, f.mime_type
+      FROM meaning_files AS f, meaning AS m, word AS w
+      WHERE f.object_pk = m.pk AND m.word_pk = w.pk
+    )
+    UPDATE dictionary AS d
+      SET
+        count_words = (SELECT count(*) FROM word AS w WHERE w.dictionary_pk = d.pk),
+        count_audio = (
+          SELECT count(*) FROM media
+          WHERE media.dictionary_pk = d.pk AND media.mime_type ILIKE 'audio/%'),
+        count_image = (
+          SELECT count(*) FROM media
+          WHERE media.dictionary_pk = d.pk AND media.mime_type ILIKE 'image/%'),
+        semantic_domains = (
+          SELECT coalesce(string_agg(s.sd, ' ; ' ORDER BY s.sd), '')
+          FROM (
+            SELECT DISTINCT trim(sd) COLLATE "C" AS sd
+            FROM word AS w, regexp_split_to_table(w.semantic_domain, ' ; ') AS sd
+            WHERE w.dictionary_pk = d.pk
+          ) AS s
+          WHERE s.sd != '')
+      WHERE d.pk {scope}
+    """)
+
+    # Distinct values of custom fields - if there are less than 40 - are used as choices
+    # for the column filters in the words table:
+    values = {}
+    for dpk, key, count, vals in execute("""
+    SELECT
+      w.dictionary_pk,
+      ud.key,
+      count(DISTINCT ud.value),
+      CASE WHEN count(DISTINCT ud.value) < 40 THEN array_agg(DISTINCT ud.value) END
+    FROM unit_data AS ud, word AS w
+    WHERE ud.object_pk = w.pk AND w.dictionary_pk {scope}
+    GROUP BY w.dictionary_pk, ud.key
+    """):
+        values[dpk, key] = vals
+
+    # Parts of speech are used as choices for the corresponding column filter:
+    pos = {dpk: vals for dpk, vals in execute("""
+    SELECT dictionary_pk, array_agg(DISTINCT pos)
+    FROM word
+    WHERE pos != '' AND dictionary_pk {scope}
+    GROUP BY dictionary_pk
+    """)}
+
+    for d in scoped(DBSession.query(Dictionary), Dictionary.pk):
         choices = {}
         for col in d.jsondata.get('custom_fields', []):
-            values = [
-                r[0] for r in DBSession.query(common.Unit_data.value)
-                .filter(common.Unit_data.object_pk.in_(word_pks))
-                .filter(common.Unit_data.key == col)
-                .distinct()]
-            if len(values) < 40:
-                choices[col] = sorted(values)
-        d.update_jsondata(choices=choices)
+            vals = values.get((d.pk, col), [])
+            if vals is not None:
+                choices[col] = sorted(vals)
+        d.update_jsondata(choices=choices, pos=sorted(pos.get(d.pk, [])))
 
-    DBSession.execute("""
+    dataset = DBSession.query(common.Dataset).one()
+    dataset.update_jsondata(dictionary_names=sorted(
+        n for n, in DBSession.query(Dictionary.name).distinct() if n))
+
+    execute("""
     UPDATE word
-      SET example_count = s.c 
+      SET example_count = s.c
       FROM (
         SELECT m.word_pk AS wpk, count(ms.sentence_pk) AS c
         FROM meaning AS m, meaningsentence AS ms
         WHERE m.pk = ms.meaning_pk
         GROUP BY m.word_pk
       ) AS s
-      WHERE word.pk = s.wpk
+      WHERE word.pk = s.wpk AND word.dictionary_pk {scope}
+    """)
+
+    #
+    # Refresh the listing of the words in the words table of a dictionary.
+    #
+    execute("DELETE FROM wordlisting WHERE dictionary_pk {scope}")
+    execute("""
+    INSERT INTO wordlisting
+      (pk, dictionary_pk, name, number, pos, description, example_count,
+       semantic_domain, comparison_meanings, data, jsondata, active, created, updated)
+      SELECT
+        w.pk, w.dictionary_pk, u.name, w.number, w.pos, u.description, w.example_count,
+        w.semantic_domain, w.comparison_meanings,
+        coalesce(
+          (SELECT jsonb_object_agg(ud.key, ud.value)
+           FROM (
+             -- Repeated keys are aggregated into one value, see util.MULT_VALUE_SEP:
+             SELECT key, string_agg(value, ' ; ' ORDER BY ord, pk) AS value
+             FROM unit_data WHERE object_pk = w.pk
+             GROUP BY key
+           ) AS ud),
+          '{{}}'),
+        '{{}}', true, now(), now()
+      FROM word AS w, unit AS u
+      WHERE w.pk = u.pk AND w.dictionary_pk {scope}
     """)
+    thumbnails = OrderedDict()
+    for cls, query in [
+        (common.Unit_files, DBSession.query(common.Unit_files, Word.pk)
+            .join(Word, Word.pk == common.Unit_files.object_pk)
+            .order_by(common.Unit_files.pk)),
+        (Meaning_files, DBSession.query(Meaning_files, Word.pk)
+            .join(Meaning, Meaning.pk == Meaning_files.object_pk)
+            .join(Word, Word.pk == Meaning.word_pk)
+            .order_by(Meaning.ord, Meaning_files.pk)),
+    ]:
+        for f, wpk in scoped(
+                query.filter(cls.mime_type.ilike('image/%')), Word.dictionary_pk):
+            thumbnails.setdefault(wpk, bitstream_url(f, type_='thumbnail'))
+    if thumbnails:
+        DBSession.execute(
+            "UPDATE wordlisting SET thumbnail = :thumbnail WHERE pk = :pk",
+            [dict(pk=pk, thumbnail=url) for pk, url in thumbnails.items()])
+
+    #
+    # Write the static downloads.
+    #
+    export.export(dpks)
+
+    #
+    # Start a new data generation - once the data is committed - so cached pages are
+    # rendered again.
+    #
+    transaction.get().addAfterCommitHook(lambda success: success and cache.bump())
 
 
 if __name__ == '__main__':
@@ -284,4 +541,17 @@ if __name__ == '__main__':
         (("--internal",), dict(action='store_true')),
         (("--no-concepts",), dict(action='store_true')),
         (("--dict",), dict()),
-        create=main, prime_cache=prime_cache)
+        (("--bulk",), dict(
+            action='store_true',
+            help="write rows with batched executemany instead of the ORM")),
+        (("--jobs",), dict(
+            type=int,
+            default=1,
+            help="number of worker processes parsing submissions (implies --bulk)")),
+        (("--incremental",), dict(
+            action='store_true',
+            help="only reload dictionaries with changed submission files")),
+        create=main,
+        prime_cache=prime_cache,
+        # The app is bootstrapped to render links in prime_cache from its route patterns:
+        bootstrap=True)
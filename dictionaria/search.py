@@ -0,0 +1,59 @@
+# coding: utf8
+"""
+Accent- and case-insensitive substring search, backed by trigram indexes.
+
+Search conditions compare the values of the immutable SQL function `unaccent_lower` -
+lowercased, unaccented text - so they can use an index on the same expression, created
+with `index`. The query syntax is the one of `clld.db.util.icontains`, i.e. "^" or "\\b"
+and "$" or "\\b" anchor the query at the start or end of the value.
+"""
+from __future__ import unicode_literals
+import re
+
+from sqlalchemy import func
+
+__all__ = ['index', 'search']
+
+START = re.compile(r'^(\^|\\b)')
+END = re.compile(r'(\$|\\b)$')
+
+
+def index(name, col, bind):
+    """
+    Create a `pg_trgm` index for `search` on a column.
+    """
+    bind.execute("CREATE EXTENSION IF NOT EXISTS unaccent WITH SCHEMA public")
+    bind.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public")
+    # unaccent is only STABLE, because the dictionary could be changed. We fix the
+    # dictionary, thus can declare the function as IMMUTABLE, which is required for use
+    # in an index:
+    bind.execute("""
+CREATE OR REPLACE FUNCTION public.unaccent_lower(text) RETURNS text AS
+$$ SELECT lower(public.unaccent('public.unaccent'::regdictionary, $1)) $$
+LANGUAGE sql IMMUTABLE STRICT""")
+    bind.execute(
+        "CREATE INDEX IF NOT EXISTS {0} ON {1} "
+        "USING gin (public.unaccent_lower({2}) gin_trgm_ops)".format(
+            name, col.table.name, col.name))
+
+
+def pattern(qs):
+    """
+    :return: `LIKE` pattern for a query.
+    """
+    start, end = '%', '%'
+    if START.search(qs):
+        start, qs = '', START.sub('', qs)
+    if END.search(qs):
+        end, qs = '', END.sub('', qs)
+    # Prevent invalid LIKE patterns:
+    if qs.endswith('\\') and not qs.endswith('\\\\'):
+        qs += '\\'
+    return start + qs + end
+
+
+def search(col, qs):
+    """
+    :return: Search condition matching values of `col` containing the query.
+    """
+    return func.unaccent_lower(col).like(func.unaccent_lower(pattern(qs)))
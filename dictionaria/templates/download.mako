@@ -1,6 +1,45 @@
 <%inherit file="home_comp.mako"/>
 <%namespace name="util" file="util.mako"/>
+<%! from clldutils.misc import format_size %>
 
 <h3>Downloads</h3>
 
+% if downloads:
+<p>
+    The data of each dictionary is available for download as tables in CSV format -
+    with the columns of the corresponding components of
+    <a href="https://cldf.clld.org">CLDF</a> dictionaries - with the sources in BibTeX
+    format, and as <a href="http://jsonlines.org">JSON Lines</a>, one JSON object per
+    entry. All files are gzip compressed.
+</p>
+<table class="table table-condensed table-nonfluid">
+    <thead>
+    <tr>
+        <th>Dictionary</th>
+        <th>File</th>
+        <th class="right">Records</th>
+        <th class="right">Size</th>
+        <th>MD5 checksum</th>
+    </tr>
+    </thead>
+    <tbody>
+        % for id_, spec in downloads:
+            % for i, f in enumerate(spec['files']):
+            <tr>
+                <td>
+                    % if i == 0:
+                    <a href="${request.route_url('contribution', id=id_)}">${spec['name']}</a>
+                    % endif
+                </td>
+                <td><a href="${request.static_url('dictionaria:static/download/' + f['name'])}">${f['name']}</a></td>
+                <td class="right">${f['records']}</td>
+                <td class="right">${format_size(f['size'])}</td>
+                <td><code>${f['md5']}</code></td>
+            </tr>
+            % endfor
+        % endfor
+    </tbody>
+</table>
+% else:
 <div class="alert alert-info">... Coming soon ...</div>
+% endif
@@ -10,7 +10,8 @@
                     % if a.description and fmt == 'long':
                         <p>${a.description}</p>
                     % endif
-                    ${h.rendered_sentence(a.sentence, fmt=fmt)}
+                    ## Gloss abbreviations are looked up once per page, if provided:
+                    ${h.rendered_sentence(a.sentence, abbrs=context.get('abbrs'), fmt=fmt)}
                     % if a.sentence.alt_translation1:
                         <div class="alt_translation">
                             <span class="alt-translation alt-translation1 translation">${a.sentence.alt_translation1}</span>
@@ -50,14 +51,20 @@
                 </td>
             </tr>
         % endif
-        % if [m for m in ctx.meanings if m.reverse]:
+        <% reverse = [m for m in ctx.meanings if m.reverse] %>
+        % if reverse:
+            <%
+                cms = context.get('counterpart_meanings')
+                if cms is None:
+                    cms = set(c.valueset.parameter.name for c in ctx.counterparts)
+            %>
             <tr>
                 <td><small>comparison meanings</small></td>
                 <td>
                     <ul class="unstyled">
-                        % for m in ctx.meanings:
+                        % for m in reverse:
                             % for re in m.reverse_list:
-                                % if re not in [c.valueset.parameter.name for c in ctx.counterparts]:
+                                % if re not in cms:
                                     <li>${re}</li>
                                 % endif
                             % endfor
@@ -10,6 +10,46 @@ import pytest
         ('get_dt', '/contributions'),
         ('get_dt', '/units'),
         ('get_html', '/contributions/daakaka'),
+        ('get_json', '/search?q=fish'),
+        ('get_json', '/search?q=fish&dictionary=daakaka&limit=5'),
+        ('get_html', '/download'),
+        ('get', '/contributions/daakaka/words.jsonl'),
+        ('get', '/contributions/daakaka/words.csv?limit=10'),
+        ('get_json', '/_cache'),
     ])
 def test_pages(app, method, path):
     getattr(app, method)(path)
+
+
+@pytest.mark.parametrize(
+    "query",
+    ['limit=x', 'limit=-1', 'after=xyz'])
+def test_words_invalid(app, query):
+    app.get('/contributions/daakaka/words.jsonl?' + query, status=400)
+
+
+def test_unit_queries(app):
+    from sqlalchemy import event
+    from clld.db.meta import DBSession
+    from dictionaria.models import Word
+
+    large = DBSession.query(Word).order_by(Word.example_count.desc()).first()
+    small, warm = DBSession.query(Word)\
+        .filter(Word.dictionary_pk == large.dictionary_pk, Word.example_count > 0)\
+        .order_by(Word.example_count, Word.pk)[:2]
+    counts = []
+
+    def count(*args, **kw):
+        counts[-1] += 1
+
+    event.listen(DBSession.bind, 'before_cursor_execute', count)
+    try:
+        # The first request warms up caches - requesting a page not rendered before, since
+        # rendered pages are cached, too. The number of queries for a word must not depend
+        # on the number of its meanings and examples:
+        for word in [warm, small, large]:
+            counts.append(0)
+            app.get_html('/units/{0}'.format(word.id))
+    finally:
+        event.remove(DBSession.bind, 'before_cursor_execute', count)
+    assert counts[1] == counts[2] < 30
@@ -0,0 +1,80 @@
+# coding: utf8
+from __future__ import unicode_literals, print_function, division
+import os
+import threading
+
+from clldutils.path import Path
+
+from dictionaria.lib.cache import generation, bump, LRU, FileBackend, FragmentCache
+
+
+def test_generation(tmpdir):
+    path = Path(str(tmpdir.join('generation.txt')))
+    assert generation(path) == '0'
+    stamp = bump(path)
+    assert generation(path) == stamp
+    stamp = bump(path)
+    assert generation(path) == stamp
+
+
+def test_LRU():
+    lru = LRU(maxsize=2)
+    lru.set('a', 'A')
+    lru.set('b', 'B')
+    assert lru.get('a') == 'A'
+    lru.set('c', 'C')
+    assert lru.get('b') is None
+    assert len(lru) == 2
+    lru.clear()
+    assert lru.get('a') is None
+
+
+def test_FileBackend(tmpdir):
+    backend = FileBackend(Path(str(tmpdir.join('cache'))), maxsize=7)
+    backend.set('a', 'äää')
+    assert backend.get('a') == 'äää'
+    os.utime(backend._path('a').as_posix(), (0, 0))
+    backend.set('b', 'bb')
+    assert backend.get('a') is None and backend.get('b') == 'bb'
+    assert len(backend) == 1
+    backend.clear()
+    assert len(backend) == 0 and backend.size == 0
+
+
+def test_FragmentCache(tmpdir):
+    path = Path(str(tmpdir.join('generation.txt')))
+    cache = FragmentCache(LRU(), generation_path=path)
+    assert cache.get('k', lambda: 'x') == 'x'
+    assert cache.get('k', lambda: 'y') == 'x'
+    bump(path)
+    assert cache.get('k', lambda: 'y') == 'y'
+    stats = cache.stats()
+    assert (stats['items'], stats['hits'], stats['misses']) == (1, 1, 2)
+
+
+def test_FragmentCache_shared(tmpdir):
+    path = Path(str(tmpdir.join('generation.txt')))
+    backend = FileBackend(Path(str(tmpdir.join('cache'))))
+    cache1 = FragmentCache(backend, generation_path=path)
+    cache2 = FragmentCache(FileBackend(backend.directory), generation_path=path)
+    assert cache1.get('k', lambda: 'x') == 'x'
+    bump(path)
+    assert cache1.get('k', lambda: 'y') == 'y'
+    # Another process seeing the new generation keeps the items added for it:
+    assert cache2.get('k', lambda: 'z') == 'y'
+    assert len(backend) == 2
+
+
+def test_FragmentCache_threads(tmpdir):
+    cache = FragmentCache(LRU(10), generation_path=Path(str(tmpdir.join('g.txt'))))
+
+    def get():
+        for i in range(1000):
+            cache.get('{0}'.format(i % 20), lambda: 'x')
+
+    threads = [threading.Thread(target=get) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert cache.hits + cache.misses == 8000
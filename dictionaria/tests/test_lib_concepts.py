@@ -0,0 +1,45 @@
+from __future__ import unicode_literals
+
+import pytest
+
+from dictionaria.lib.concepts import get_matcher, lemmatize
+
+
+@pytest.mark.parametrize(
+    "gloss,lemmas",
+    [
+        ('dog', []),
+        ('dogs', ['dog']),
+        ('boxes', ['box']),
+        ('stones', ['stone', 'ston']),
+        ('knives', ['knife']),
+        ('flies', ['fly']),
+        ('news', []),
+        ('bad dogs', ['bad dog']),
+    ]
+)
+def test_lemmatize(gloss, lemmas):
+    assert lemmatize(gloss) == lemmas
+
+
+@pytest.mark.parametrize(
+    "gloss,gloss_",
+    [
+        ('dogs', 'DOG'),
+        ('ears', 'EAR'),
+        ('boxes', 'BOX'),
+        ('stones', 'STONE'),
+        ('knives', 'KNIFE'),
+        ('buses', 'BUS'),
+        ('houses', 'HOUSE'),
+        ('leaves', 'LEAF'),
+        ('wolves', 'WOLF'),
+        ('mice', 'MOUSE'),
+        ('flies', 'FLY (MOVE THROUGH AIR)'),
+        ('news', None),
+        ('to', None),
+    ]
+)
+def test_Matcher(gloss, gloss_):
+    match = get_matcher().match(gloss)
+    assert (match[1] if match else None) == gloss_
@@ -8,3 +8,15 @@ def test_Example():
     id_ = e.id
     e.set('ref', 'x')
     assert id_ != e.id
+
+
+def test_ComparisonMeaning():
+    from dictionaria.lib.ingest import ComparisonMeaning
+
+    assert ComparisonMeaning('eat').id == '1336'
+    assert ComparisonMeaning('To eat (sth.).').id == '1336'
+    assert ComparisonMeaning('houses').id == '1252'
+    assert ComparisonMeaning('xyzzy').id is None
+    # Fuzzy matches with low confidence are rejected:
+    assert ComparisonMeaning('news').id is None
+    assert ComparisonMeaning('to').id is None
@@ -0,0 +1,37 @@
+# coding: utf8
+from __future__ import unicode_literals, print_function, division
+
+from dictionaria.lib.media import Catalogue, Files
+
+
+def test_Catalogue():
+    spec = dict(original='a.wav', mimetype='audio/x-wav', objid='EAEA0-1')
+    cat = Catalogue({'0123456789abcdef0123456789abcdef': spec, 'x': dict(original='x')})
+    assert len(cat) == 2
+    assert '0123456789ABCDEF0123456789ABCDEF' in cat
+    assert cat.get('0123456789abcdef0123456789abcdef') == spec
+    assert cat.get('x') == dict(original='x')
+    assert cat.get('0123456789abcdef0123456789abcdeg') is None
+
+
+def test_Files(capsys):
+    class Obj(object):
+        def __init__(self, pk):
+            self.pk, self.id = pk, 'w{0}'.format(pk)
+
+    class Writer(list):
+        def add(self, model, **kw):
+            self.append((model, kw))
+
+    files = Files(
+        Catalogue({'a': dict(original='a.wav', mimetype='audio/x-wav')}),
+        dict(audio=dict(license='CC-BY')))
+    for obj in [Obj(1), Obj(1), Obj(2)]:
+        files.add('audio', 'a', 'Unit_files', obj)
+        files.add('audio', 'b', 'Unit_files', obj)
+    writer = Writer()
+    files.flush(writer)
+    assert [kw['id'] for _, kw in writer] == ['w1-a', 'w2-a']
+    assert writer[0][1]['jsondata']['license'] == 'CC-BY'
+    files.report()
+    assert '1 audio files missing: b' in capsys.readouterr()[0]
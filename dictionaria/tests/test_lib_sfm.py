@@ -1,7 +1,10 @@
 # coding: utf8
 from __future__ import unicode_literals, print_function, division
 
-from dictionaria.lib.sfm import Entry
+from clldutils.path import Path
+
+from dictionaria.lib.sfm import Entry, iter_entries
+from dictionaria.lib.ingest import Example
 
 
 def test_Entry():
@@ -191,3 +194,45 @@ across a slope
     assert words[1].ps == 'v.tr.gen'
     assert len(words[0].meanings) == 2
     assert len(words[1].meanings) == 1
+
+
+def test_EntryHomonymNumbers():
+    e = Entry.from_string(r"""
+\lx kaka
+\sn 1
+\ps n
+\ge bird
+\cf kaka2
+\sn 2
+\ps v
+\ge shout
+\nt note
+""")
+    words = list(e.get_words())
+    assert [w.id for w in words] == ['kaka1', 'kaka2']
+    assert [w.ps for w in words] == ['n', 'v']
+    assert words[0].rel == [('see also', 'kaka2')]
+    assert words[1].data == {'nt': ['note']}
+
+
+def test_iter_entries(tmpdir):
+    db = Path(str(tmpdir.join('db.sfm')))
+    with db.open('w', encoding='utf8') as fp:
+        fp.write('\\_sh v3.0\n\n\\lx a\n\\ps n\n\n\\lx b\n\\de x \\lx y\n')
+    entries = iter_entries(db)
+    assert not isinstance(entries, list)
+    assert [e.get('lx') for e in entries] == ['\\_sh v3.0', 'a', 'b', 'y']
+    # Entries are parsed as with clldutils.sfm.SFM.from_file:
+    assert [list(e) for e in iter_entries(db)] == [
+        [('lx', '\\_sh v3.0')],
+        [('lx', 'a'), ('ps', 'n')],
+        [('lx', 'b'), ('de', 'x')],
+        [('lx', 'y')]]
+
+
+def test_iter_entries_blank_lines(tmpdir):
+    examples = Path(str(tmpdir.join('examples.sfm')))
+    with examples.open('w', encoding='utf8') as fp:
+        fp.write('\\ref 1\n\\tx a\n\n\n\\ref 2\n\\tx b\nc\n')
+    exs = list(iter_entries(examples, Example, entry_sep='\n\n', entry_prefix=None))
+    assert [(ex.id, ex.text) for ex in exs] == [('1', 'a'), ('2', 'b\nc')]
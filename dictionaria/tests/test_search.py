@@ -0,0 +1,20 @@
+# coding: utf8
+from __future__ import unicode_literals
+
+import pytest
+
+from dictionaria.search import pattern
+
+
+@pytest.mark.parametrize(
+    "qs,pattern_",
+    [
+        ('fish', '%fish%'),
+        ('^fish', 'fish%'),
+        ('fish$', '%fish'),
+        ('\\bfish\\b', 'fish'),
+        ('fish\\', '%fish\\\\%'),
+        ('fish\\\\', '%fish\\\\%'),
+    ])
+def test_pattern(qs, pattern_):
+    assert pattern(qs) == pattern_
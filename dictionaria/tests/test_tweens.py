@@ -0,0 +1,38 @@
+from __future__ import unicode_literals
+
+from pyramid.request import Request
+from pyramid.response import Response
+
+from dictionaria import tweens
+
+
+def test_conditional_get_tween(mocker):
+    handler = mocker.Mock(side_effect=lambda req: Response('x'))
+    tween = tweens.conditional_get_tween_factory(handler, None)
+
+    res = tween(Request.blank('/units/1'))
+    assert res.etag and res.cache_control.max_age == 3600
+    assert set(res.vary) == {'Accept', 'X-Requested-With'}
+    assert handler.call_count == 1
+
+    res = tween(Request.blank('/units/1', headers={'If-None-Match': '"%s"' % res.etag}))
+    assert res.status_int == 304
+    assert set(res.vary) == {'Accept', 'X-Requested-With'}
+    assert handler.call_count == 1
+
+    res = tween(Request.blank('/units/2', headers={'If-None-Match': '"%s"' % res.etag}))
+    assert res.status_int == 200
+    assert handler.call_count == 2
+
+    res = tween(Request.blank(
+        '/units?sEcho=1', headers={'X-Requested-With': 'XMLHttpRequest'}))
+    assert res.cache_control.max_age == 300
+
+    res = tween(Request.blank('/_cache'))
+    assert not res.etag
+
+    # Requests are classified independently of the prefix the app is mounted at:
+    res = tween(Request.blank('/_cache', base_url='http://x/dictionaria'))
+    assert not res.etag
+    res = tween(Request.blank('/static/x.css', base_url='http://x/_app'))
+    assert not res.etag
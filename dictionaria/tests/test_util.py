@@ -0,0 +1,23 @@
+# coding: utf8
+from __future__ import unicode_literals, print_function, division
+
+from pyramid import testing
+
+from dictionaria.util import Linker, Link, APP_URL
+
+
+def test_Linker():
+    linker = Linker('d', ['1-1', '1-10', '2', ''], 'unit')
+    assert linker('') == ''
+    assert linker('see 1-1, 1-10 and 2.\n2x 12 1-1') == \
+        'see **unit:d-1-1**, **unit:d-1-10** and **unit:d-2**.\n2x 12 **unit:d-1-1**'
+    assert Linker('d', [], 'unit')('see 1') == 'see 1'
+
+
+def test_Link_url():
+    with testing.testConfig() as config:
+        config.add_route('unit', '/units/{id}')
+        req = testing.DummyRequest()
+        assert Link(None, 'unit').url(req, 'd-1') == 'http://example.com/units/d-1'
+        assert Link(None, 'unit').url(req, 'd-1', app_url=APP_URL) == \
+            APP_URL + '/units/d-1'
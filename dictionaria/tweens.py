@@ -0,0 +1,99 @@
+"""
+Conditional GET, based on the data generation.
+
+Since all responses only change when the data changes - i.e. with each run of
+`prime_cache`, see `dictionaria.lib.cache` - the entity tag of a response can be computed
+from the data generation and the request alone. Thus, requests with a matching
+`If-None-Match` - or `If-Modified-Since` - header are answered with `304 Not Modified`
+before any database query or template rendering.
+
+.. note:: Deployments changing the code, but not the data, must bump the data generation
+   to invalidate cached responses.
+"""
+from __future__ import unicode_literals
+from hashlib import md5
+import calendar
+import os
+
+from pyramid.httpexceptions import HTTPNotModified
+
+from dictionaria.lib.cache import generation, GENERATION
+
+__all__ = ['conditional_get_tween_factory']
+
+# Request headers the representation depends on, see `etag`:
+VARY = ('Accept', 'X-Requested-With')
+
+# Cache-Control policies for families of routes:
+CACHE_CONTROL = {
+    'datatable': 'public, max-age=300',
+    'page': 'public, max-age=3600',
+    'download': 'public, max-age=86400',
+}
+
+
+def family(request):
+    """
+    :return: The name of the family of routes `request` is for, or `None` for requests \
+    which are not handled by the tween.
+    """
+    # Routes are matched against `path_info`, i.e. without the prefix the app is mounted at.
+    path = request.path_info
+    if request.method not in ('GET', 'HEAD') or path.startswith('/_'):
+        return
+    if path.startswith('/static/'):
+        return 'download' if path.startswith('/static/download/') else None
+    if request.is_xhr and 'sEcho' in request.params:
+        return 'datatable'
+    return 'page'
+
+
+def etag(request, stamp):
+    """
+    :return: Strong entity tag for the response to `request` in data generation `stamp`.
+    """
+    # The representation depends on content negotiation and on whether the request is XHR.
+    return md5('\n'.join([
+        stamp,
+        request.host_url,
+        request.path_qs,
+        request.headers.get('Accept', ''),
+        '{0}'.format(request.is_xhr),
+    ]).encode('utf8')).hexdigest()
+
+
+def not_modified(request, tag, mtime):
+    if request.if_none_match:
+        return tag in request.if_none_match
+    if mtime and request.if_modified_since:
+        return calendar.timegm(request.if_modified_since.utctimetuple()) >= int(mtime)
+    return False
+
+
+def conditional_get_tween_factory(handler, registry):
+    def conditional_get_tween(request):
+        family_ = family(request)
+        if family_ is None:
+            return handler(request)
+
+        tag = etag(request, generation())
+        try:
+            mtime = os.stat(GENERATION.as_posix()).st_mtime
+        except OSError:
+            mtime = None
+
+        if not_modified(request, tag, mtime):
+            response = HTTPNotModified()
+        else:
+            response = handler(request)
+            if response.status_int != 200:
+                return response
+        response.etag = tag
+        if mtime:
+            response.last_modified = int(mtime)
+        response.headers['Cache-Control'] = str(CACHE_CONTROL[family_])
+        vary = tuple(response.vary or ())
+        response.vary = vary + tuple(h for h in VARY if h not in vary)
+        return response
+
+    return conditional_get_tween
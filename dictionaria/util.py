@@ -1,6 +1,6 @@
 # coding: utf8
 from __future__ import unicode_literals
-from collections import OrderedDict, defaultdict
+from collections import OrderedDict
 import re
 
 from clldutils.text import truncate_with_ellipsis
@@ -8,42 +8,174 @@ from clldutils.misc import UnicodeMixin
 from clld.web.util.htmllib import HTML
 from clld.db.models import common
 from clld.db.meta import DBSession
+from sqlalchemy import or_
 from bs4 import BeautifulSoup
 from clldmpg import cdstar
 from clld.web.util.helpers import link
 assert cdstar and link
 
 MULT_VALUE_SEP = ' ; '
+# Application URL of links in HTML pre-rendered in prime_cache - replaced with the URL the
+# app is served at, when the HTML is served:
+APP_URL = 'http://__app_url__'
 
 
-def add_links2(sid, ids, desc, type_):
-    if not desc:
-        return
-    if not ids:
-        return desc
-    p = re.compile(
-        '((?<=\W)|^)(?P<id>{0})(?=\W|$)'.format('|'.join(re.escape(id_) for id_ in ids if id_)),
-        flags=re.MULTILINE)
-    return p.sub(lambda m: '{0}'.format(Link(sid + '-' + m.group('id'), type_)), desc)
+WORD_CHAR = re.compile('\w')
 
 
-def unit_detail_html(request=None, context=None, **kw):
-    labels = {}
-    for type_, cls in [('source', common.Source), ('unit', common.Unit)]:
-        labels[type_] = defaultdict(set)
-        for r in DBSession.query(cls.id):
-            sid, _, lid = r[0].partition('-')
-            labels[type_][sid].add(lid)
+class Linker(object):
+    """
+    Marks up references to objects of one type and dictionary - i.e. occurrences of their
+    local IDs delimited by non-word characters - as `Link`s.
+
+    Rather than trying an alternation of all IDs at each position of the text, the linker
+    only considers positions where an ID may start and looks up the substrings with the
+    lengths of known IDs in a set, so matching time is linear in the length of the text
+    and does not depend on the number of IDs. If IDs overlap, the longest one is linked.
+    """
+    def __init__(self, sid, ids, type_):
+        self.sid, self.type = sid, type_
+        self.ids = set(id_ for id_ in ids if id_)
+        self.lengths = sorted(set(len(id_) for id_ in self.ids), reverse=True)
+        self.starts = re.compile(
+            '((?<=\W)|^)(?=[{0}])'.format(
+                ''.join(re.escape(c) for c in sorted(set(id_[0] for id_ in self.ids)))),
+            flags=re.MULTILINE) if self.ids else None
+
+    def matches(self, s):
+        """
+        :return: Generator of `(start, end)` offsets of the IDs referenced in `s`.
+        """
+        if not self.ids:
+            return
+        end = 0
+        for m in self.starts.finditer(s):
+            i = m.start()
+            if i < end:
+                continue
+            for length in self.lengths:
+                j = i + length
+                if j <= len(s) \
+                        and (j == len(s) or not WORD_CHAR.match(s, j)) \
+                        and s[i:j] in self.ids:
+                    yield i, j
+                    end = j
+                    break
+
+    def __call__(self, s):
+        if not s:
+            return s
+        chunks, end = [], 0
+        for i, j in self.matches(s):
+            chunks.append(s[end:i])
+            chunks.append('{0}'.format(Link(self.sid + '-' + s[i:j], self.type)))
+            end = j
+        if not chunks:
+            return s
+        chunks.append(s[end:])
+        return ''.join(chunks)
+
+
+class LinkIndex(object):
+    """
+    `Linker`s for the objects of a dictionary which may be referenced in its texts, i.e.
+    sources and words, identified by their IDs without the "<dictionary ID>-" prefix.
+    """
+    types = ['source', 'unit']
+
+    def __init__(self, dictionary):
+        from dictionaria.models import Word, DictionarySource
+
+        self.id = dictionary.id
+        self.fingerprint = dictionary.jsondata.get('fingerprint')
+        self.linkers = {}
+        for type_, cls in [('source', DictionarySource), ('unit', Word)]:
+            self.linkers[type_] = Linker(
+                self.id,
+                [r[0][len(self.id) + 1:] for r in DBSession.query(cls.id)
+                 .filter(cls.dictionary_pk == dictionary.pk)],
+                type_)
+
+    def add_links(self, s):
+        """
+        Mark up references to sources and words of the dictionary as `Link`s.
+        """
+        for type_ in self.types:
+            s = self.linkers[type_](s)
+        return s
+
+
+_link_indexes = {}
+
+
+def link_index(dictionary):
+    """
+    :return: The `LinkIndex` for a dictionary - cached per process and rebuilt when the \
+    dictionary has been reloaded from a changed submission.
+    """
+    index = _link_indexes.get(dictionary.id)
+    if index is None or index.fingerprint != dictionary.jsondata.get('fingerprint'):
+        index = _link_indexes[dictionary.id] = LinkIndex(dictionary)
+    return index
+
 
+def unit_detail_html(request=None, context=None, **kw):
+    index = link_index(context.dictionary)
     res = {}
     for k, v in context.datadict().items():
         if k.endswith('_links'):
             v = v.replace('<', '&lt;').replace('>', '&gt;')
-            for type_ in ['source', 'unit']:
-                v = add_links2(
-                    context.dictionary.id, labels[type_][context.dictionary.id], v, type_)
-            res[k.replace('_links', '')] = add_links(request, v)
-    return dict(links=res)
+            res[k.replace('_links', '')] = add_links(request, index.add_links(v))
+    return dict(
+        links=res,
+        # Names of the comparison meanings the word is a counterpart for:
+        counterpart_meanings=set(c.valueset.parameter.name for c in context.counterparts),
+        # Gloss abbreviations for all examples - which are in the language of the word:
+        abbrs={g.id: g.name for g in DBSession.query(common.GlossAbbreviation).filter(or_(
+            common.GlossAbbreviation.language_pk == context.language_pk,
+            common.GlossAbbreviation.language_pk == None))})  # noqa: E711
+
+
+def dictionary_description(dictionary, req=None, app_url=None):
+    """
+    :return: Pair `(html, toc)` of the description of a dictionary, with references to \
+    sources and words resolved as HTML links, and its table of contents.
+    """
+    html, toc_ = toc(dictionary.description)
+    return add_links(req, html, app_url=app_url), '{0}'.format(toc_)
+
+
+def prerendered_description(dictionary, req):
+    """
+    Render the description of a dictionary for storage, i.e. independent of the URL the
+    app is served at: Links use `APP_URL` as application URL, see
+    `contribution_detail_html`.
+
+    :param req: A request of the app - providing the route patterns.
+    """
+    return dictionary_description(dictionary, req, app_url=APP_URL)
+
+
+def contribution_detail_html(request=None, context=None, **kw):
+    if 'description_html' in context.jsondata:
+        # pre-rendered in prime_cache:
+        return dict(
+            description=context.jsondata['description_html'].replace(
+                APP_URL, request.application_url),
+            toc=context.jsondata['toc'])
+    html, toc_ = dictionary_description(context, request)
+    return dict(description=html, toc=toc_)
+
+
+def download(request=None, context=None, **kw):
+    """
+    :return: The static downloads - as listed in the manifest written in prime_cache - \
+    ordered by dictionary name.
+    """
+    from dictionaria.lib.export import manifest
+
+    downloads = manifest()
+    return dict(downloads=sorted(downloads.items(), key=lambda i: i[1]['name']))
 
 
 def truncate(s):
@@ -76,23 +208,39 @@ class Link(UnicodeMixin):
     def __unicode__(self):
         return '**{0.type}:{0.id}**'.format(self)
 
-    def sub(self, s, req, labels=None):
+    def sub(self, s, req, labels=None, app_url=None):
         if not labels:
+            # Only look up the objects which are actually referenced:
             cls = getattr(common, self.type.capitalize())
-            labels = {r[0]: r[1] for r in DBSession.query(cls.id, cls.name)}
+            ids = set(m.group('id') for m in self.pattern.finditer(s))
+            labels = {r[0]: r[1] for r in DBSession.query(cls.id, cls.name)
+                      .filter(cls.id.in_(ids))} if ids else {}
 
         def _repl(m):
             if m.group('id') in labels:
                 return '<a href="{0}">{1}</a>'.format(
-                    req.route_url(self.type, id=m.group('id')), labels[m.group('id')])
+                    self.url(req, m.group('id'), app_url=app_url),
+                    labels[m.group('id')])
             return m.string
 
-        return re.sub('\*\*{0}:(?P<id>[^*]+)\*\*'.format(self.type), _repl, s)
+        return self.pattern.sub(_repl, s)
+
+    def url(self, req, id_, app_url=None):
+        """
+        :param app_url: Application URL to use instead of the one of `req`.
+        :return: Absolute URL of the object.
+        """
+        kw = {'_app_url': app_url} if app_url else {}
+        return req.route_url(self.type, id=id_, **kw)
+
+    @property
+    def pattern(self):
+        return re.compile('\*\*{0}:(?P<id>[^*]+)\*\*'.format(self.type))
 
 
-def add_links(req, s):
+def add_links(req, s, app_url=None):
     for type_ in ['source', 'unit']:
-        s = Link(None, type_).sub(s, req)
+        s = Link(None, type_).sub(s, req, app_url=app_url)
     return s
 
 
@@ -1,9 +1,63 @@
 from __future__ import unicode_literals
+import json
 
 from pyramid.view import view_config
+from pyramid.response import Response
+from pyramid.httpexceptions import HTTPBadRequest, HTTPServiceUnavailable, HTTPNotFound
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
 
 from clld.db.models.common import Unit, Language
 
+from dictionaria.models import Dictionary, Word, WordListing
+from dictionaria.lib.export import csv_chunk
+from dictionaria.interfaces import IFragmentCache
+
+try:
+    from html import escape
+except ImportError:  # pragma: no cover
+    from cgi import escape
+
+# Markers for highlighted words in snippets, replaced with HTML after escaping the text:
+START_SEL, STOP_SEL = '\x02', '\x03'
+SEARCH_SQL = """\
+WITH hits AS (
+  SELECT w.pk, ts_rank_cd(w.fts, plainto_tsquery('english', :q)) AS rank
+  FROM word AS w
+  WHERE w.fts @@ plainto_tsquery('english', :q) {dictionaries}
+)
+SELECT
+  h.pk,
+  h.rank,
+  u.id,
+  u.name,
+  w.number,
+  c.id,
+  c.name,
+  ts_headline(
+    'english',
+    coalesce(w.serialized, u.name),
+    plainto_tsquery('english', :q),
+    'StartSel={start}, StopSel={stop}, MaxFragments=2, MaxWords=20, MinWords=5')
+FROM
+  (
+    SELECT pk, rank FROM hits {after} ORDER BY rank DESC, pk DESC LIMIT :limit
+  ) AS h, word AS w, unit AS u, contribution AS c
+WHERE h.pk = w.pk AND w.pk = u.pk AND w.dictionary_pk = c.pk
+ORDER BY h.rank DESC, h.pk DESC"""
+WORDS_SQL = """\
+SELECT
+  u.id, wl.name, wl.number, wl.pos, wl.description, wl.semantic_domain,
+  wl.comparison_meanings, wl.example_count, wl.data
+FROM wordlisting AS wl, unit AS u
+WHERE wl.pk = u.pk AND wl.dictionary_pk = :pk {after}
+ORDER BY wl.name, wl.number, wl.pk
+{limit}"""
+WORDS_COLUMNS = [
+    'ID', 'Headword', 'Homonym_Number', 'Part_Of_Speech', 'Description',
+    'Semantic_Domain', 'Comparison_Meanings', 'Example_Count']
+WORDS_BATCH_SIZE = 1000
+
 
 def home(request):
     word1 = request.db.query(Unit)\
@@ -11,3 +65,180 @@ def home(request):
         .filter(Unit.name == 'caa')\
         .filter(Language.name == 'Hooca\u0328k').first()
     return {'example1': word1, 'example2': Unit.get('72141525536263472')}
+
+
+def snippet(s):
+    return escape(s).replace(START_SEL, '<mark>').replace(STOP_SEL, '</mark>')
+
+
+def search(request):
+    """
+    Full-text search of the entries of all - or selected - dictionaries.
+
+    Query parameters:
+    - `q`: the search terms,
+    - `dictionary`: comma-separated list of dictionary IDs to restrict the search to,
+    - `limit`: the number of results per page (at most 100),
+    - `after`: the cursor returned as `next` with the previous page of results.
+
+    Results are ranked with `ts_rank_cd` and come with highlighted snippets of the entry.
+    Since ranking requires scoring all matching entries, queries are run with the
+    statement timeout configured as `dictionaria.search_timeout` (in milliseconds).
+    """
+    q = request.params.get('q', '').strip()
+    if not q:
+        raise HTTPBadRequest('Missing search terms: q')
+    params = dict(q=q, limit=100)
+    try:
+        params['limit'] = min(int(request.params.get('limit', 20)), params['limit'])
+    except ValueError:
+        raise HTTPBadRequest('Invalid limit')
+
+    dictionaries, after = '', ''
+    if request.params.get('dictionary'):
+        dictionaries = 'AND w.dictionary_pk IN ' \
+                       '(SELECT pk FROM contribution WHERE id = ANY(:dictionaries))'
+        params['dictionaries'] = [
+            d.strip() for d in request.params['dictionary'].split(',') if d.strip()]
+    if request.params.get('after'):
+        # Keyset pagination: The cursor is the rank and pk of the last result.
+        try:
+            rank, pk = request.params['after'].split(',')
+            params.update(rank=float(rank), pk=int(pk))
+        except ValueError:
+            raise HTTPBadRequest('Invalid cursor')
+        after = 'WHERE (rank, pk) < (CAST(:rank AS real), :pk)'
+
+    conn = request.db.bind.connect()
+    trans = conn.begin()
+    try:
+        conn.execute('SET LOCAL statement_timeout = {0}'.format(
+            int(request.registry.settings.get('dictionaria.search_timeout', 3000))))
+        rows = conn.execute(
+            SEARCH_SQL.format(
+                dictionaries=dictionaries, after=after, start=START_SEL, stop=STOP_SEL),
+            params).fetchall()
+    except OperationalError:
+        raise HTTPServiceUnavailable('Search query too expensive')
+    finally:
+        trans.rollback()
+        conn.close()
+
+    def results():
+        yield '{"results": ['
+        for i, (pk, rank, id_, name, number, did, dname, headline) in enumerate(rows):
+            yield (',' if i else '') + json.dumps(dict(
+                id=id_,
+                name=name,
+                number=number or None,
+                url=request.route_url('unit', id=id_),
+                dictionary=dict(id=did, name=dname),
+                rank=rank,
+                snippet=snippet(headline)))
+        cursor = None
+        if len(rows) == params['limit']:
+            cursor = '{0!r},{1}'.format(rows[-1][1], rows[-1][0])
+        yield '], "next": {0}}}'.format(json.dumps(cursor))
+
+    return Response(
+        app_iter=(chunk.encode('utf8') for chunk in results()),
+        content_type='application/json',
+        charset='utf8')
+
+
+def words(request):
+    """
+    All words of a dictionary in alphabetical order - streamed as JSON Lines or CSV.
+
+    Query parameters:
+    - `after`: the ID of a word - to continue a download after this word,
+    - `limit`: the maximal number of words - a non-negative integer.
+
+    Words are ordered by name, homonym number and pk and read from a server-side cursor,
+    thus, any dictionary can be downloaded in one request.
+
+    Words are read from the word listing, so the download is unavailable until
+    `prime_cache` has been run.
+    """
+    dictionary = Dictionary.get(request.matchdict['id'], default=None)
+    if not dictionary:
+        raise HTTPNotFound()
+    if request.db.query(Word.pk).filter(Word.dictionary_pk == dictionary.pk).first() \
+            and not request.db.query(WordListing.pk)\
+            .filter(WordListing.dictionary_pk == dictionary.pk).first():
+        raise HTTPServiceUnavailable('Word listing not yet computed')
+    params, after, limit = dict(pk=dictionary.pk), '', ''
+    if request.params.get('after'):
+        # Keyset pagination: The words after the sort key of the given word.
+        last = request.db.query(WordListing.name, WordListing.number, WordListing.pk)\
+            .join(Unit, Unit.pk == WordListing.pk)\
+            .filter(Unit.id == request.params['after'])\
+            .filter(WordListing.dictionary_pk == dictionary.pk)\
+            .first()
+        if not last:
+            raise HTTPBadRequest('Invalid cursor')
+        params.update(name=last[0], number=last[1], after=last[2])
+        after = 'AND (wl.name, wl.number, wl.pk) > (:name, :number, :after)'
+    if request.params.get('limit'):
+        try:
+            params['limit'] = int(request.params['limit'])
+        except ValueError:
+            raise HTTPBadRequest('Invalid limit')
+        # Errors must be raised before the response is streamed:
+        if params['limit'] < 0:
+            raise HTTPBadRequest('Invalid limit')
+        limit = 'LIMIT :limit'
+    custom_fields = dictionary.custom_field_keys()
+    ext = request.matchdict['ext']
+
+    def batches():
+        conn = request.db.bind.connect()
+        trans = conn.begin()
+        try:
+            rows = conn.execution_options(stream_results=True).execute(
+                text(WORDS_SQL.format(after=after, limit=limit)), params)
+            while True:
+                batch = rows.fetchmany(WORDS_BATCH_SIZE)
+                if not batch:
+                    break
+                yield batch
+        finally:
+            trans.rollback()
+            conn.close()
+
+    def jsonl():
+        for batch in batches():
+            lines = []
+            for id_, name, number, pos, desc, sd, cm, example_count, data in batch:
+                lines.append(json.dumps(dict(
+                    id=id_,
+                    name=name,
+                    number=number or None,
+                    url=request.route_url('unit', id=id_),
+                    pos=pos,
+                    description=desc,
+                    semantic_domain=sd,
+                    comparison_meanings=cm,
+                    example_count=example_count,
+                    data=data)))
+            yield ''.join(line + '\n' for line in lines).encode('utf8')
+
+    def csv():
+        yield csv_chunk([WORDS_COLUMNS + custom_fields])
+        for batch in batches():
+            yield csv_chunk(
+                list(row[:-1]) + [(row[-1] or {}).get(f) for f in custom_fields]
+                for row in batch)
+
+    return Response(
+        app_iter=jsonl() if ext == 'jsonl' else csv(),
+        content_type='application/x-ndjson' if ext == 'jsonl' else 'text/csv',
+        charset='utf8')
+
+
+def cache_stats(request):
+    """
+    :return: Counters of the cache of rendered pages.
+    """
+    cache = request.registry.queryUtility(IFragmentCache)
+    return cache.stats() if cache else {}
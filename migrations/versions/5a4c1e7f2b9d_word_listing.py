@@ -0,0 +1,42 @@
+"""word listing
+
+Revision ID: 5a4c1e7f2b9d
+Revises: 3659fbd1a6c1
+Create Date: 2026-10-18 10:12:31.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5a4c1e7f2b9d'
+down_revision = '3659fbd1a6c1'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.create_table(
+        'wordlisting',
+        sa.Column('pk', sa.Integer(), sa.ForeignKey('word.pk'), primary_key=True),
+        sa.Column('dictionary_pk', sa.Integer(), sa.ForeignKey('dictionary.pk')),
+        sa.Column('name', sa.Unicode()),
+        sa.Column('number', sa.Integer()),
+        sa.Column('pos', sa.Unicode()),
+        sa.Column('description', sa.Unicode()),
+        sa.Column('example_count', sa.Integer()),
+        sa.Column('semantic_domain', sa.Unicode()),
+        sa.Column('comparison_meanings', sa.Unicode()),
+        sa.Column('data', postgresql.JSONB()),
+        sa.Column('thumbnail', sa.Unicode()),
+        sa.Column('jsondata', sa.Unicode()),
+        sa.Column('active', sa.Boolean()),
+        sa.Column('created', sa.DateTime(timezone=True)),
+        sa.Column('updated', sa.DateTime(timezone=True)))
+    op.create_index('ix_wordlisting_dictionary_pk', 'wordlisting', ['dictionary_pk'])
+
+
+def downgrade():
+    op.drop_table('wordlisting')
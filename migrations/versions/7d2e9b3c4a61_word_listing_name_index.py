@@ -0,0 +1,28 @@
+"""word listing name index
+
+Revision ID: 7d2e9b3c4a61
+Revises: 5a4c1e7f2b9d
+Create Date: 2026-10-18 16:40:12.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7d2e9b3c4a61'
+down_revision = '5a4c1e7f2b9d'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+
+def upgrade():
+    op.drop_index('ix_wordlisting_dictionary_pk', 'wordlisting')
+    op.create_index(
+        'ix_wordlisting_dictionary_pk_name',
+        'wordlisting',
+        ['dictionary_pk', 'name', 'number', 'pk'])
+
+
+def downgrade():
+    op.drop_index('ix_wordlisting_dictionary_pk_name', 'wordlisting')
+    op.create_index('ix_wordlisting_dictionary_pk', 'wordlisting', ['dictionary_pk'])
@@ -0,0 +1,35 @@
+"""unit name trigram index
+
+Revision ID: 9b4f6e2d1c83
+Revises: 7d2e9b3c4a61
+Create Date: 2026-10-18 20:05:47.000000
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9b4f6e2d1c83'
+down_revision = '7d2e9b3c4a61'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+
+def upgrade():
+    # See dictionaria.search.index
+    op.execute("CREATE EXTENSION IF NOT EXISTS unaccent WITH SCHEMA public")
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm WITH SCHEMA public")
+    op.execute("""
+CREATE OR REPLACE FUNCTION public.unaccent_lower(text) RETURNS text AS
+$$ SELECT lower(public.unaccent('public.unaccent'::regdictionary, $1)) $$
+LANGUAGE sql IMMUTABLE STRICT""")
+    op.execute(
+        "CREATE INDEX IF NOT EXISTS unit_name_trgm_index ON unit "
+        "USING gin (public.unaccent_lower(name) gin_trgm_ops)")
+
+
+def downgrade():
+    op.execute("DROP INDEX IF EXISTS unit_name_trgm_index")
+    op.execute("DROP FUNCTION IF EXISTS public.unaccent_lower(text)")
+    op.execute("DROP EXTENSION IF EXISTS pg_trgm")
+    op.execute("DROP EXTENSION IF EXISTS unaccent")